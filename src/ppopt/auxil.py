@@ -4,6 +4,8 @@
 
 import numpy as np
 from copy import deepcopy
+from array import array
+import heapq
 
 
 # ------------------------------CLASS DEFINITIONS----------------------------------
@@ -41,6 +43,321 @@ class Oper:
             strRep+=' | change tip'
         return strRep
 
+# Compact sequence of operations, stored as parallel arrays of part types, part numbers, wells and tip change indicators
+# Can be used instead of a list of Oper objects (e.g. as fin): indexing it gives an OperView of the stored operation
+class Plan:
+    # initialisation (optionally, from an iterable of operations)
+    def __init__(self, ops=()):
+        self.types = array('i')
+        self.nums = array('i')
+        self.wells = array('i')
+        self.changes = array('b')
+        for op in ops:
+            self.append(op)
+
+    # record a new operation at the end of the sequence
+    def append(self, op):
+        self.types.append(op.part[0])
+        self.nums.append(op.part[1])
+        self.wells.append(op.well)
+        self.changes.append(op.changed)
+
+    # record a new operation at position i
+    def insert(self, i, op):
+        self.types.insert(i, op.part[0])
+        self.nums.insert(i, op.part[1])
+        self.wells.insert(i, op.well)
+        self.changes.insert(i, op.changed)
+
+    # remove the operation at position i, returning it as an Oper object
+    def pop(self, i=-1):
+        op = Oper((self.types.pop(i), self.nums.pop(i)), self.wells.pop(i))
+        op.changed = bool(self.changes.pop(i))
+        return op
+
+    # tip change indicators as a NumPy array (shares memory with the plan)
+    def changed_array(self):
+        return np.frombuffer(self.changes, dtype=np.int8)
+
+    def __len__(self):
+        return len(self.wells)
+
+    def __getitem__(self, i):
+        # slicing gives a new plan
+        if(isinstance(i, slice)):
+            sliced = Plan()
+            sliced.types = self.types[i]
+            sliced.nums = self.nums[i]
+            sliced.wells = self.wells[i]
+            sliced.changes = self.changes[i]
+            return sliced
+
+        # otherwise, get a view of a single operation
+        if(i<0):
+            i += len(self.wells)
+        if not (0<=i<len(self.wells)):
+            raise IndexError('plan index out of range')
+        return OperView(self, i)
+
+    def __setitem__(self, i, op):
+        self.types[i] = op.part[0]
+        self.nums[i] = op.part[1]
+        self.wells[i] = op.well
+        self.changes[i] = op.changed
+
+    def __iter__(self):
+        for i in range(0, len(self.wells)):
+            yield OperView(self, i)
+
+
+# Single operation stored in a Plan, behaving like an Oper object (changing it changes the plan)
+class OperView:
+    __slots__ = ('plan', 'index')
+
+    # initialisation
+    def __init__(self, plan, index):
+        self.plan = plan
+        self.index = index
+
+    @property
+    def part(self):
+        return (self.plan.types[self.index], self.plan.nums[self.index])
+
+    @property
+    def well(self):
+        return self.plan.wells[self.index]
+
+    @property
+    def changed(self):
+        return bool(self.plan.changes[self.index])
+
+    @changed.setter
+    def changed(self, value):
+        self.plan.changes[self.index] = bool(value)
+
+    # for printing the part type and destination well
+    __str__ = Oper.__str__
+
+
+# State of the pipette tip: which part it holds and how many doses of this part it has delivered since it was taken
+# Updated every time an operation is appended to (or removed from) the sequence, so capacity checks take O(1) time
+class TipState:
+    # initialisation (no tip taken yet)
+    def __init__(self):
+        self.part = None
+        self.doses = 0
+        self.history = [] # previous states of the tip, needed to undo operations
+
+    # record a new operation; changed is True if the tip is changed before performing it
+    def push(self, part, changed):
+        self.history.append((self.part, self.doses))
+        if(changed):
+            self.part = part
+            self.doses = 1
+        else:
+            self.doses += 1
+
+    # undo the last recorded operation
+    def pop(self):
+        self.part, self.doses = self.history.pop()
+
+    # get a copy of the current state (without the history), e.g. to branch the search
+    def copy(self):
+        tipcopy = TipState()
+        tipcopy.part = self.part
+        tipcopy.doses = self.doses
+        return tipcopy
+
+    # check if the tip has delivered as many doses as it can hold
+    def full(self, caps):
+        return (caps!=None) and (self.doses>=caps[self.part])
+
+
+# Unperformed operations grouped by part, so that the ones which can continue with the same tip are found quickly
+# Each part's bucket is a dictionary of operation indices (in the original order of operations), allowing O(1) removal
+class PartBuckets:
+    # initialisation; pids gives the part id of every operation
+    def __init__(self, pids, n_parts):
+        self.pids = pids
+        self.buckets = [{} for p in range(0, n_parts)]
+        for i in range(0, len(pids)):
+            self.buckets[pids[i]][i] = None
+        self.remain = np.bincount(pids, minlength=n_parts) # number of unperformed operations for each part
+        self.left = len(pids) # total number of unperformed operations
+        self.taken = np.zeros(len(pids), dtype=bool) # operations temporarily taken out (e.g. by lookahead search)
+
+    # permanently remove operation i
+    def remove(self, i):
+        del self.buckets[self.pids[i]][i]
+        self.remain[self.pids[i]] -= 1
+        self.left -= 1
+
+    # temporarily take out operation i (keeping the order of operations intact)...
+    def take(self, i):
+        self.taken[i] = True
+        self.remain[self.pids[i]] -= 1
+        self.left -= 1
+
+    # ...and put it back
+    def putback(self, i):
+        self.taken[i] = False
+        self.remain[self.pids[i]] += 1
+        self.left += 1
+
+    # get all unperformed operations of part p, in original order
+    def candidates(self, p):
+        return [i for i in self.buckets[p] if not self.taken[i]]
+
+    # get the parts with unperformed operations and the first unperformed operation for each of them
+    def firsts(self):
+        parts = np.flatnonzero(self.remain)
+        firstops = np.zeros(len(parts), dtype=int)
+        for k in range(0, len(parts)):
+            for i in self.buckets[parts[k]]:
+                if not self.taken[i]:
+                    firstops[k] = i
+                    break
+        return parts, firstops
+
+    # iterate over all unperformed operations in original order
+    def __iter__(self):
+        return heapq.merge(*[(i for i in bucket if not self.taken[i]) for bucket in self.buckets if len(bucket) != 0])
+
+
+# The input compiled into contiguous NumPy structures, shared by all optimisation methods
+# w can be the usual 2D-list of parts, or an integer array of shape (wells, part types, 2) - the latter is not copied
+class Problem:
+    # initialisation
+    def __init__(self, w, caps=None):
+        # PART 1: get w as an integer array
+        if(isinstance(w, np.ndarray)):
+            self.warr = w
+            self.w = None # the 2D-list form is only made if needed
+        else:
+            self.warr = np.array(w, dtype=int).reshape((len(w), len(w[0]), 2))
+            self.w = w
+        self.n_wells = self.warr.shape[0]
+        self.n_types = self.warr.shape[1]
+
+        # part number matrix: entry [i][j] is the number of the part at address j in well i
+        # (all parts at address j are of the same type j, so the number alone identifies the part)
+        self.wmat = self.warr[:, :, 1]
+
+        # PART 2: intern the parts, numbering them in the order of first appearance (same as in w_to_subsets)
+        codes = (self.warr[:, :, 0] * (self.wmat.max() + 1) + self.wmat).ravel()
+        uniq, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+        order = np.argsort(first) # unique codes sorted by first appearance
+        rank = np.empty(len(order), dtype=int)
+        rank[order] = np.arange(0, len(order))
+        self.partid = rank[inverse].reshape((self.n_wells, self.n_types)) # entry [i][j] is id of part at address j in well i
+        self.parts = [(int(cell[0]), int(cell[1])) for cell in self.warr.reshape((-1, 2))[first[order]]] # part tuple of each id
+        self.n_parts = len(self.parts)
+
+        # PART 3: index of wells containing each part (CSR format: wells of part p are wells[indptr[p]:indptr[p+1]])
+        cells = np.argsort(self.partid.ravel(), kind='stable')
+        self.wells = cells // self.n_types
+        self.indptr = np.zeros(self.n_parts + 1, dtype=int)
+        np.cumsum(np.bincount(self.partid.ravel(), minlength=self.n_parts), out=self.indptr[1:])
+
+        # PART 4: capacities, also as an array indexed by part id
+        self.caps = caps
+        if(caps!=None):
+            self.caparr = np.array([caps[part] for part in self.parts], dtype=int)
+        else:
+            self.caparr = None
+
+        # PART 5: well compatibility data (calculated when first needed)
+        self.samearr = None
+
+    # wells to which the part with a given id is added
+    def partwells(self, p):
+        return self.wells[self.indptr[p]:self.indptr[p + 1]]
+
+    # well compatibility: entry [j][a][b] is True if wells a and b have the same part at address j
+    def same(self):
+        if(self.samearr is None):
+            wmatT = self.wmat.T
+            self.samearr = (wmatT[:, :, None] == wmatT[:, None, :])
+        return self.samearr
+
+    # get the input as a 2D-list of parts
+    def aslist(self):
+        if(self.w==None):
+            self.w = [[self.parts[p] for p in row] for row in self.partid.tolist()]
+        return self.w
+
+    # let the problem be used wherever a 2D-list of parts is expected
+    def __len__(self):
+        return self.n_wells
+
+    def __getitem__(self, i):
+        return self.aslist()[i]
+
+
+# compile the input into a Problem, unless this has already been done
+# A Problem keeps the capacities it was compiled with: it is reused if caps is None or equal to them, and any other caps
+# raise an error (rather than the Problem being solved with capacities other than those given)
+def to_problem(w, caps=None):
+    if(isinstance(w, Problem)):
+        if(caps is None or caps is w.caps or caps==w.caps):
+            return w
+        raise ValueError('the capacities given differ from those the problem was compiled with')
+    return Problem(w, caps)
+
+
+# Recomputes the tip changes of a sequence of operations one operation at a time, without copying the sequence
+# If keepchanges is True, the tip changes already indicated in the sequence are also made (e.g. to check an output plan)
+class PlanChecker:
+    # initialisation
+    def __init__(self, w, caps, keepchanges=False):
+        self.prob = to_problem(w, caps)
+        self.caps = self.prob.caps
+        self.keepchanges = keepchanges
+        self.added = np.zeros((self.prob.n_wells, self.prob.n_types), dtype=bool) # tells which parts were added to which well
+        self.lastpart = None # part added in the last checked operation
+        self.lastwell = None # destination well of the last checked operation
+        self.doses = 0 # doses delivered by the current tip
+        self.count = 0 # number of checked operations
+        self.cost = 0 # number of tip changes required so far
+        self.different = [] # operations whose tip change indicator differs from the recomputed one
+
+    # check the next operation, return 1 if it requires a tip change and 0 if not
+    def step(self, op):
+        # PART 1: get the operation's cost
+        # first operation or different reagent from the last one => new tip needed
+        if(self.count==0 or self.lastpart!=op.part):
+            cost=1
+        else:
+            # check if the last well had any parts (other than the current one) the next well does not
+            lastwell = self.lastwell
+            contam = self.added[lastwell].copy()
+            contam[op.part[0]] = False
+            harmless = (self.prob.wmat[lastwell] == self.prob.wmat[op.well]) & self.added[op.well]
+            cost = int(np.any(contam & ~harmless))
+
+            # take into account pipette capacity, IF working with a capacitated problem
+            if(cost==0 and self.caps!=None and self.doses>=self.caps[op.part]):
+                cost=1
+
+        # PART 2: record the differing tip change indicator
+        if(self.count!=0 and op.changed!=(cost==1)):
+            diffop = Oper(op.part, op.well)
+            diffop.changed = (cost==1)
+            self.different.append((diffop, str(self.count)))
+
+        # PART 3: update the state
+        self.added[op.well][op.part[0]] = True
+        if(cost==1 or (self.keepchanges and op.changed)):
+            self.doses = 1
+        else:
+            self.doses += 1
+        self.lastpart = op.part
+        self.lastwell = op.well
+        self.count += 1
+        self.cost += cost
+        return cost
+
+
 # Needed for the sametogether reordering
 class Sametogether:
     def __init__(self, parttype):
@@ -79,8 +396,27 @@ def capac(pipcap, dose, airgap):
 
 
 # -------------------------------COST FUNCTIONS------------------------------------
+# get the state of the tip after performing all operations in fin (for callers that do not keep track of it)
+def tipstate_from_fin(fin):
+    tip = TipState()
+    # the tip was last changed at the latest operation with a tip change indicator
+    backforcap = 0
+    while (backforcap<len(fin)):
+        backforcap += 1
+        if(fin[-backforcap].changed):
+            break
+    if(len(fin)!=0):
+        tip.part = fin[-1].part
+        tip.doses = backforcap
+    return tip
+
+
 # calculate cost based on tip change indicators of the operations in the sequence
 def route_cost(fin):
+    # for a compact plan, just sum the array of tip change indicators
+    if(isinstance(fin, Plan)):
+        return int(fin.changed_array().sum())
+
     cost=0 # initialise the cost variable
 
     # sum the tip changing indicators (which are 1 if tip is changed, 0 otherwise)
@@ -94,48 +430,30 @@ def route_cost(fin):
 # get route cost independently from the tip change indicators in fin (the well/parts array w is required!)
 # use for testing
 def independent_cost(fin,w,caps):
-    # PART 1: initial preparations
-
-    # make a copy, reset its tip change indicators
-    cfin=deepcopy(fin)
-    for i in range(0, len(cfin)):
-        cfin[i].changed = False
-
-    # array listing operations that have different tip changing status than originally given
-    # Note: even if it is non-empty, this does not necessarily mean the original caluclation is wrong
-    different=[]
+    return verify_plan(fin,w,caps)
 
-    # create the array added (tells which parts were added to which well)
-    added = np.zeros((len(w), len(w[0])),dtype=bool) # added[i][j]==True if part at address j in well i has been added
 
+# single-pass plan verification: returns the independently calculated cost and the array of differing operations
+# (each differing operation is given as a tuple of the operation with recomputed tip change indicator and its place in fin)
+# Note: even if the array is non-empty, this does not necessarily mean the original caluclation is wrong
+def verify_plan(fin, w, caps):
+    checker = PlanChecker(w, caps)
+    for op in fin:
+        checker.step(op)
+    return checker.cost, checker.different
 
-    # PART 2: get the cost
-
-    # PART 2.1: the first operation in fin
-    cost=1 # beginning the distribuiton => new tip taken
-    cfin[0].changed = True # indicate the tip's been changed
-    added[cfin[0].well][cfin[0].part[0]] = 1 # indicate the part's been added
-
-    # PART 2.2: all other operations
-    for i in range(1, len(cfin)):
-        one_cost = cost_func_with_w(cfin[0:i], cfin[i], w, added, caps) # get operation cost
-        cost += one_cost # add operation cost
-
-        added[cfin[i].well][cfin[i].part[0]] = 1 # indicate the part's been added
-        # if the tip's been changed (operation cost 1), indicate that
-        if(one_cost==1):
-            cfin[i].changed = True
-
-        # if the independently found tip-changing indicator is different, record!
-        if (fin[i].changed != cfin[i].changed):
-            different.append((cfin[i],str(i))) # record a tuple giving the operation and its place in the sequence
 
-    # PART 3: return the cost and the array of differing operations
-    return cost, different
+# iterator form of plan verification: for every operation in fin, yields it and its recomputed cost
+# (lets the plan be checked while it is being read, e.g. when producing the action list)
+def verify_iter(fin, w, caps, keepchanges=False):
+    checker = PlanChecker(w, caps, keepchanges)
+    for op in fin:
+        yield op, checker.step(op)
 
 
 # cost of a single operation op; uses the well array w and the array added giving status of the wells
-def cost_func_with_w(fin, op, w, added, caps):
+# tip is the TipState after performing fin; if not given, it is found by going back through fin
+def cost_func_with_w(fin, op, w, added, caps, tip=None):
     # if no operations have been performed at all, new tip obiously needed => just return 1
     if(len(fin)==0):
         return 1
@@ -161,20 +479,97 @@ def cost_func_with_w(fin, op, w, added, caps):
         if(caps!=None):
             # only need to do that if cost is ostensibly 0 and the number of operations is less than the capacity
             if((cost==0) and (len(fin)>=caps[op.part])):
-                # see how many doses of current part have been delivered
-                backforcap = 0
-                while (backforcap<len(fin)):
-                    backforcap += 1
-                    if(fin[-backforcap].changed):
-                        break
+                if(tip==None):
+                    tip = tipstate_from_fin(fin)
 
                 # if there is now more room for one more dose for delivery, will have to get a new tip
-                if(backforcap==caps[op.part]):
+                if(tip.full(caps)):
                     cost=1
 
     return cost
 
 
+# costs of many candidate operations at once; uses the part number matrix wmat (see Problem) and the array added
+# cands is an integer array whose rows are (part type, part number, destination well) - see ops_to_array
+# tip is the TipState after performing fin; if not given, it is found by going back through fin
+def cost_func_batch(fin, cands, wmat, added, caps, tip=None):
+    # by default, every candidate needs a new tip (cost=1)
+    costs = np.ones(len(cands), dtype=int)
+
+    # if no operations have been performed at all, new tip obiously needed => just return 1s
+    if(len(fin)==0):
+        return costs
+
+    # find the part and destination well of the last operation performed
+    lastpart = fin[-1].part
+    lastwell = fin[-1].well
+
+    # only the operations involving the same reagent as the last one can avoid a tip change
+    same = np.flatnonzero((cands[:, 0] == lastpart[0]) & (cands[:, 1] == lastpart[1]))
+    if(len(same)==0):
+        return costs
+
+    # parts (other than the current one) already present in the last well contaminate the tip...
+    contam = added[lastwell].copy()
+    contam[lastpart[0]] = False
+    # ...which is harmless only if the next well has the same part at that address, and it has already been added
+    candwells = cands[same, 2]
+    harmless = (wmat[candwells] == wmat[lastwell]) & added[candwells]
+    samecosts = np.any(contam & ~harmless, axis=1).astype(int)
+
+    # take into account pipette capacity, IF working with a capacitated problem
+    if(caps!=None):
+        # only need to do that if the number of operations is less than the capacity (unless the tip state is given,
+        # which allows fin to hold only the last operation)
+        if(tip!=None or len(fin)>=caps[lastpart]):
+            if(tip==None):
+                tip = tipstate_from_fin(fin)
+
+            # if there is now more room for one more dose for delivery, will have to get a new tip
+            if(tip.full(caps)):
+                samecosts[:] = 1
+
+    costs[same] = samecosts
+    return costs
+
+
+# -------------------------------LOWER BOUNDS--------------------------------------
+# Fast lower bounds on the number of tips any plan requires, used to report how far a plan may be from the optimum
+
+# each tip only delivers one part, and at most as many doses as the pipette's capacity allows
+def part_bound(w, caps):
+    w = to_problem(w, caps)
+    counts = np.diff(w.indptr) # number of wells each part is added to
+    if(w.caparr is None):
+        return w.n_parts
+    return int((-(-counts // w.caparr)).sum())
+
+
+# A tip is kept after adding the last part to a well only if the next well has the same part in every address (so the
+# last well's parts can't contaminate it), i.e. the same composition. For each composition, the well that is the last
+# to be completed is not followed by any well with the same composition still missing a part, so its tip is thrown away.
+# Hence at least one tip is used per distinct well composition
+def composition_bound(w):
+    w = to_problem(w)
+    return len(np.unique(w.partid, axis=0))
+
+
+# the best of the lower bounds on the number of tips
+# Note: the LP method's per-subset bound (lp_cap_bound) is not summed here, as it depends on the order the subsets are
+# processed in. Without a fixed order, a tip can go between any two wells of a part (if the part is added to the first
+# well before its other parts), so the per-subset bound reduces to part_bound; composition_bound accounts for contamination
+def lower_bound(w, caps):
+    w = to_problem(w, caps)
+    return max(part_bound(w, caps), composition_bound(w))
+
+
+# optimality gap of a plan with a given cost, in percent of the cost (the optimum is at least lb)
+def optimality_gap(cost, lb):
+    if(cost==0):
+        return 0.0
+    return (cost - lb) / cost * 100
+
+
 # -----------------------------INPUT CONVERSION------------------------------------
 """
 The input can be stored as:
@@ -187,21 +582,10 @@ Conversion between these data types is often necessary
 
 # convert w into subsets
 def w_to_subsets(w,subsets):
-    for i in range(0, len(w)):
-        for j in range(0, len(w[0])):
-            # check if there already is a subset for the current reagent
-            match = False
-            for k in range(0, len(subsets)):
-                if (subsets[k].part == w[i][j]):
-                    match = True
-                    break
-
-            # if yes, just add the current well into the relevant subset
-            if (match):
-                subsets[k].nuwell(i)
-            # if no, create a new subset
-            else:
-                subsets.append(Ss(w[i][j], i))
+    prob = to_problem(w)
+    for p in range(0, prob.n_parts):
+        subsets.append(Ss(prob.parts[p], 0))
+        subsets[-1].wells = prob.partwells(p).tolist()
 
 
 # convert subsets into operations list
@@ -231,32 +615,39 @@ def ops_to_subsets(ops, subsets):
 #convert the array w into operations list
 # get a list of all operations from w
 def w_to_ops(w, ops, reord):
+    prob = to_problem(w)
+
     # no reordering => just convert w into ops
     if (reord == None):
-        for well in range(0, len(w)):
-            for part in range(0, len(w[well])):
-                ops.append(Oper(w[well][part], well))
+        for well in range(0, prob.n_wells):
+            for p in prob.partid[well]:
+                ops.append(Oper(prob.parts[p], well))
         return
 
     # random reordering => convert into ops, randomly shuffle ops
     elif (reord == 'random'):
-        for well in range(0, len(w)):
-            for part in range(0, len(w[well])):
-                ops.append(Oper(w[well][part], well))
+        for well in range(0, prob.n_wells):
+            for p in prob.partid[well]:
+                ops.append(Oper(prob.parts[p], well))
         np.random.shuffle(ops)
         return
 
     # subset-based reorderings => convert into subsets, apply a corresponding reordering, convert into ops
     if (reord == 'leastout' or reord == 'sametogether' or reord == 'justsubsets'):
         subsets = []
-        w_to_subsets(w, subsets)
+        w_to_subsets(prob, subsets)
         if (reord == 'sametogether'):
-            sametogether(subsets, w)
+            sametogether(subsets, prob)
         else:
-            leastout(subsets,w)
+            leastout(subsets,prob)
         subsets_to_ops(subsets, ops)
 
 
+# convert the operations list into an integer array with rows (part type, part number, destination well)
+def ops_to_array(ops):
+    return np.array([(op.part[0], op.part[1], op.well) for op in ops], dtype=int).reshape((len(ops), 3))
+
+
 # -----------------------------HEURISTIC REORDERINGS------------------------------------
 # Reorder the list of DNA parts to improve the optimisation algorithms' performance
 
@@ -131,7 +131,7 @@ def basic_part_transfer_actions_onelen(method, final_assembly_dict, part_vol, pi
     caps = capacities(reqvols=reqvols, pipcap=pipette_volume, airgap=air_gap)
 
     # PART 2 Solve the problem
-    fin = []  # output operations (internal format)
+    fin = Plan()  # output operations (internal format, compact)
 
     # PART 2.1 call algorithm specified by method
     if (method[0:2] == 'LP'):  # LP-based
@@ -158,15 +158,25 @@ def basic_part_transfer_actions_onelen(method, final_assembly_dict, part_vol, pi
         elif (method[:6] == 'Greedy'):
             greedy_tree(w, fin, 'optimistic+cap', reord, caps)
 
-    # PART 2.2 Print report on solution benefits
+    # PART 2.2 Check the plan before it is reported and recorded (tip changes already in fin are kept)
+    for i, (op, cost) in enumerate(verify_iter(fin, w, caps, keepchanges=True)):
+        # if the tip cannot be kept without contamination or exceeding capacity, change it anyway
+        if (cost == 1 and not op.changed):
+            if (i != 0):
+                print('pipette_opt: WARNING - the plan keeps the tip before operation '+str(i)+' where it must be changed')
+            op.changed = True
+
+    # PART 2.3 Print report on solution benefits
     cost = route_cost(fin)
     savings = len(fin) - cost
     percentsavings = savings / len(fin) * 100
     print('pipette_opt:\n')
     print(str(savings) + ' pipette tips saved (' + str(percentsavings) + '%)')
-    print('Thus ' + str(cost) + ' tips required\n')
+    print('Thus ' + str(cost) + ' tips required')
+    lb = lower_bound(w, caps)
+    print('At least ' + str(lb) + ' tips are needed for this input (optimality gap at most ' + str(optimality_gap(cost, lb)) + '%)\n')
 
-    # PART 2.3 record
+    # PART 2.4 record
     rec('BASIC', w, fin, dic, caps)
 
     # PART 3 Convert internal-output operations into an action list
@@ -180,7 +190,7 @@ def basic_part_transfer_actions_onelen(method, final_assembly_dict, part_vol, pi
     part_vol = reqvols[fin[0].part]
     part_dest = [dic['constructs'][fin[0].well]['con_liqloc']].copy()
 
-    # PART 3.4 All later operations
+    # PART 3.3 All later operations
     for i in range(1, len(fin)):
         # act accroding to cost
         if not (fin[i].changed):  # if the tip is unchanged
@@ -1,6 +1,6 @@
 """dp - Dynamic Programming optimisation method"""
-from .dp_method import dp_method
+from .dp_method import dp_method, dp_bounded
 
 __version__ = '0.1.0'
 __author__ = 'Kirill Sechkar <kirill.sechkar18@imperial.ac.uk>'
-__all__=['dp_method']
+__all__=['dp_method', 'dp_bounded']
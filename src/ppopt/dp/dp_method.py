@@ -12,133 +12,347 @@ The resultant sequence of operations is stored in a class Oper list fin.
 """
 
 from ppopt.auxil import *
+import time
 
 # ------------------------------CLASS DEFINITIONS----------------------------------
-# recording fromat used in the DP algorithm; operation, best pre, best cost of operation sequence up to this addition
-class DPrecord:
+# records of the DP algorithm for one position in the sequence, stored column-wise (entry j is for operation j,
+# unless only some operations are kept, as in bounded DP - then op tells which operation each record is for)
+# only the latest layer is kept complete; for earlier ones, just what is needed to reconstruct the sequence is stored
+class DPlayer:
+    __slots__ = ('op', 'bestcost', 'previndex', 'changed', 'doses', 'added', 'n_types')
+
+    # initialisation
+    def __init__(self, n, w):
+        self.op = np.arange(n) # which operation each record is for
+        self.bestcost = np.full(n, -1.0) # cost of best operation sequence leading up to this operation; currently just initialised as -1
+        self.previndex = np.full(n, -1, dtype=np.int32) # index of the best prior operation; currently just initialised as -1
+        self.changed = np.zeros(n, dtype=bool) # indicates if this operation needs a tip change
+        self.doses = np.zeros(n, dtype=np.int32) # number of doses delivered by the current tip, including this operation
+        # state of wells at the moment (0 for unadded reagent, 1 for added), packed into bits over wells x types
+        # (one row of uint8 per record, as np.packbits would make it)
+        self.added = np.zeros((n, -(-w.n_wells * w.n_types // 8)), dtype=np.uint8)
+        self.n_types = w.n_types
+
+    # drop the information no longer needed once the next layer is filled
+    def release(self):
+        self.bestcost = None
+        self.doses = None
+        self.added = None
+
+    # mark the reagent types as added to the wells in the given records
+    def add(self, recs, wells, types):
+        bit = wells * self.n_types + types
+        self.added[recs, bit >> 3] |= (128 >> (bit & 7)).astype(np.uint8)
+
+    # check if the reagent types have been added to the wells in the given records (arguments are broadcast together)
+    def isadded(self, recs, wells, types):
+        bit = wells * self.n_types + types
+        return ((self.added[recs, bit >> 3] >> (7 - (bit & 7))) & 1).astype(bool)
+
+    # get the states of the wells in the given records, one row of reagent types per well
+    def wellrows(self, recs, wells):
+        return self.isadded(recs[:, None], wells[:, None], np.arange(self.n_types))
+
+
+# operations in array form, with everything the DP transition needs precomputed
+# (the pairs of operations with the same part are only needed by the full DP, so bounded DP can skip them)
+class DPops:
     # initialisation
-    def __init__(self, op, w, pos):
-        self.op=op # which operation is performed
-        self.added=np.zeros((len(w), len(w[0])), dtype=bool) # state of wells at the moment (0 for unadded reagent, 1 for added); currently just initialised with zeros
-        self.bestcost=-1 # cost of best operation sequence leading up to this operation; currently just initialised as -1
-        self.previndex=-1 # index of the record for best prior operation; currenlty just initialised as -1
-        self.changed=False # indicates if this operation needs a tip change
-        self.pos=pos # position of this operation in the sequence
-
-    # for printing the part type, destination well and which operation it is in the sequence
-    def __str__(self):
-        strRep = self.op.part + ' -> w' + str(self.op.well) + ' | operation no.' + str(self.pos)
-        return strRep
+    def __init__(self, ops, w, caps, pairs=True):
+        opsarr = ops_to_array(ops)
+        self.n = len(ops)
+        self.well = opsarr[:, 2] # destination well of each operation
+        self.type = opsarr[:, 0] # part address of each operation
+        pid = w.partid[self.well, self.type]
+        if (caps != None):
+            self.cap = w.caparr[pid] # capacity of the tip for each operation's part
+        else:
+            self.cap = None
+
+        # operations of each part
+        self.pid = pid
+        self.bypart = []
+        for p in range(0, w.n_parts):
+            self.bypart.append(np.flatnonzero(pid == p))
+        if (not pairs):
+            return
+
+        # pairs (k,j) of operations with the same part: only for them can operation j follow k without a tip change
+        samek = []
+        samej = []
+        for idx in self.bypart:
+            samek.append(np.repeat(idx, len(idx)))
+            samej.append(np.tile(idx, len(idx)))
+        self.samek = np.concatenate(samek)
+        self.samej = np.concatenate(samej)
+
+        # for these pairs, tell which addresses of well k are allowed to have parts in the tip:
+        # those where well j has the same part...
+        self.compat = w.same()[:, self.well[self.samej], self.well[self.samek]].T
+        # ...and the address of the part being added
+        self.notown = np.ones((len(self.samek), w.n_types), dtype=bool)
+        self.notown[np.arange(len(self.samek)), self.type[self.samek]] = False
+
 
 # ----------------- SOLVER FUNCTION -------------------
 def dp_method(w,fin,reord,caps):
     # PART 1: initial preparations
 
-    # PART 1.1: get array of records for every operation on all possible positions
-    dprecs = []
-    getdprecs(w, dprecs, reord)
+    # PART 1.0: compile the input (w can also be given as a Problem)
+    w = to_problem(w, caps)
+    caps = w.caps
+
+    # PART 1.1: get the list of all operations to be done
+    ops = []
+    w_to_ops(w, ops, reord) # reord specifies if a reordering has to be applied (see auxil.py)
+
+    # PART 1.2: get the operations in array form
+    dpops = DPops(ops, w, caps)
+    allops = np.arange(dpops.n)
 
     # PART 2: get the sequence of operations
+    dplayers = []
 
     # PART 2.1: deal with the records for the first operation in sequnce
-    for rec in dprecs[0]:
-        rec.bestcost = 1 # this is the first operation, so just 1 tip used
-        rec.changed = True  # this is the first operation, so a new tip is needed
-        rec.added[rec.op.well][rec.op.part[0]] = True # record that the operation in question has been made
+    dplayers.append(DPlayer(dpops.n, w))
+    dplayers[0].bestcost[:] = 1 # this is the first operation, so just 1 tip used
+    dplayers[0].changed[:] = True # this is the first operation, so a new tip is needed
+    dplayers[0].doses[:] = 1 # a new tip has delivered one dose
+    dplayers[0].add(allops, dpops.well, dpops.type) # record that the operation in question has been made
 
     # PART 2.2: deal with all other records
     # consider the second operation, then the third, etc.
-    for pos in range(1, len(dprecs)):
-        #print(str(pos) + ' of ' + str(len(dprecs)) + ' operations')  # uncomment if need to track the progress
+    for pos in range(1, dpops.n):
+        #print(str(pos) + ' of ' + str(dpops.n) + ' operations')  # uncomment if need to track the progress
+        prevlayer = dplayers[pos - 1]
+        layer = DPlayer(0, w) # columns are filled in below
 
-        # consider all records in this position
-        for rec in dprecs[pos]:
-            # find costs of making this operation the next after all possible prior operations
-            dpcosts = []
-            for maybeprev in dprecs[pos - 1]:
-                dpcosts.append(getdpcost(rec, maybeprev, dprecs, w, caps))
+        # find costs of making each operation the next after all possible prior operations (entry [k][j] for k before j)
+        dpcosts = getdpcosts(prevlayer, dpops)
 
-            rec.bestcost = min(dpcosts) # find the one with the best cost
-            rec.previndex = dpcosts.index(rec.bestcost) # record it as the previous operation
-            prevrec = dprecs[pos - 1][rec.previndex] # get the record of the best-cost previous operation
+        # for each operation, find the one with the best cost and record it as the previous operation
+        layer.previndex = np.argmin(dpcosts, axis=0).astype(np.int32)
+        layer.bestcost = dpcosts[layer.previndex, allops]
 
-            # copy the status of wells from the determined previous record and update it
-            rec.added = prevrec.added.copy()
-            rec.added[rec.op.well][rec.op.part[0]] = True
+        # copy the status of wells from the determined previous records and update it
+        layer.added = prevlayer.added[layer.previndex]
+        layer.add(allops, dpops.well, dpops.type)
 
-            # if needed, record that the tip must be changed here
-            if (prevrec.bestcost < rec.bestcost):
-                rec.changed = True
+        # if needed, record that the tip must be changed here
+        layer.changed = (prevlayer.bestcost[layer.previndex] < layer.bestcost)
 
+        # update the number of doses delivered by the current tip
+        layer.doses = np.where(layer.changed, 1, prevlayer.doses[layer.previndex] + 1)
 
-    # PART 3: get past
+        # only the new layer is needed in full from now on
+        prevlayer.release()
+        dplayers.append(layer)
 
-    # PART 3.1: find the record for the last operation with the lowest total cost
-    frecs = dprecs[-1]
-    finrec = min(frecs, key=lambda frecs: frecs.bestcost)
 
-    # PART 3.2: write this operation in fin
-    fin.append(finrec.op)
-    fin[-1].changed = finrec.changed # indicate whether the tip has to be changed
+    # PART 3: get past
 
-    # PART 3.3: write all the prior operations into fin
-    for pos in reversed(range(1, len(dprecs))):
-        finrec = dprecs[finrec.pos - 1][finrec.previndex] # find previous operation
-        fin.insert(0, finrec.op) # write it into fin
-        fin[0].changed = finrec.changed # indicate whether the tip has to be changed
+    # PART 3.1: find the record for the last operation with the lowest total cost
+    j = int(np.argmin(dplayers[-1].bestcost))
 
+    # PART 3.2: write this and all the prior operations into fin
+    for pos in reversed(range(0, dpops.n)):
+        fin.insert(0, ops[j]) # write it into fin
+        fin[0].changed = bool(dplayers[pos].changed[j]) # indicate whether the tip has to be changed
+        j = dplayers[pos].previndex[j] # find previous operation
 
 
-# ----------------- AUXILIARY FUNCTIONS -------------------
-# get list of type DPOper operations from w
-def getdprecs(w,dprecs,reord):
-    # PART 1: get the list of all operations to be done
-    ops=[]
-    w_to_ops(w,ops,reord) # reord specifies if a reordering has to be applied (see auxil.py)
 
-    # PART 2: create records for every operation on all possible positions in the sequence
-    for i in range(0,len(ops)):
-        dprecs.append([])
-        for j in range(0,len(ops)):
-            dprecs[i].append(DPrecord(ops[j], w, i))
+# bounded DP: only the width best records are kept for each position, and for each record only the preds best
+# previous records, plus those with the same part (which may need no tip change), are considered. Each position thus costs
+# O(preds*n + width*(most operations with one part)), so the running time grows quadratically with the number n of
+# operations (it is not yet better than Greedy+sametogether, so the assembly APIs don't offer it).
+# If a memory budget maxmem (in bytes) is given, width is reduced so that the layers kept fit into it;
+# if a time budget maxtime (in seconds) is given, width is halved every time the projected running time exceeds it.
+# A pass with width 1 is made first, and the full search is skipped if it already meets the lower bound on the tips.
+# Returns the width and the number of predecessors actually used (no more than the numbers of operations and records)
+def dp_bounded(w, fin, reord, caps, width=64, preds=8, maxmem=None, maxtime=None):
+    # PART 1: initial preparations
+    starttime = time.time()
+
+    # PART 1.0: compile the input (w can also be given as a Problem)
+    w = to_problem(w, caps)
+    caps = w.caps
+
+    # PART 1.1: get the list of all operations to be done
+    ops = []
+    w_to_ops(w, ops, reord) # reord specifies if a reordering has to be applied (see auxil.py)
+
+    # PART 1.2: get the operations in array form
+    dpops = DPops(ops, w, caps, pairs=False)
+
+    # PART 1.3: fit the width into the memory budget
+    # (while the width is below preds, the tip-change candidates only come from width records)
+    if (maxmem != None):
+        base, percand, perrec = dp_bounded_memory(dpops, w)
+        fits = (maxmem - base - preds * percand) // perrec
+        if (fits < preds):
+            fits = (maxmem - base) // (percand + perrec)
+        width = max(1, min(width, fits))
+
+    # PART 2: get the sequence of operations - with a single record per position first: if this already meets the
+    # lower bound on the number of tips, it is optimal and the full search is skipped; otherwise keep the better of the two
+    dplayers, minwidth = dp_bounded_layers(dpops, w, 1, 1, None, starttime)
+    if (width > 1 and dplayers[-1].bestcost[0] > lower_bound(w, caps)):
+        fulllayers, fullwidth = dp_bounded_layers(dpops, w, width, preds, maxtime, starttime)
+        if (fulllayers[-1].bestcost[0] <= dplayers[-1].bestcost[0]):
+            dplayers, minwidth = fulllayers, fullwidth
+
+    # PART 3: get past (records in each layer are sorted, so the first record of the last layer is the best)
+    j = 0
+    for pos in reversed(range(0, dpops.n)):
+        fin.insert(0, ops[dplayers[pos].op[j]]) # write it into fin
+        fin[0].changed = bool(dplayers[pos].changed[j]) # indicate whether the tip has to be changed
+        j = dplayers[pos].previndex[j] # find previous operation
+
+    minwidth = min(minwidth, dpops.n)
+    return minwidth, min(preds, minwidth)
 
 
+# ----------------- AUXILIARY FUNCTIONS -------------------
+# bounded DP with a given width: returns the layers of records and the smallest width actually used
+def dp_bounded_layers(dpops, w, width, preds, maxtime, starttime):
+    minwidth = width
+    dplayers = []
+
+    # PART 1: deal with the records for the first operation in sequnce - all have the same cost, so keep the first ones
+    dplayers.append(DPlayer(min(width, dpops.n), w))
+    dplayers[0].bestcost[:] = 1 # this is the first operation, so just 1 tip used
+    dplayers[0].changed[:] = True # this is the first operation, so a new tip is needed
+    dplayers[0].doses[:] = 1 # a new tip has delivered one dose
+    dplayers[0].add(np.arange(len(dplayers[0].op)), dpops.well[dplayers[0].op], dpops.type[dplayers[0].op])
+
+    # PART 2: deal with all other records
+    layertime = time.time()
+    for pos in range(1, dpops.n):
+        #print(str(pos) + ' of ' + str(dpops.n) + ' operations')  # uncomment if need to track the progress
+        prevlayer = dplayers[pos - 1]
+
+        # PART 2.1: get the best transitions to each operation and keep the width best ones
+        layer = getbestrecs(prevlayer, dpops, w, width, preds)
+
+        # PART 2.2: copy the status of wells from the previous records and update it
+        recs = np.arange(len(layer.op))
+        layer.added = prevlayer.added[layer.previndex]
+        layer.add(recs, dpops.well[layer.op], dpops.type[layer.op])
+
+        # PART 2.3: update the number of doses delivered by the current tip
+        layer.doses = np.where(layer.changed, 1, prevlayer.doses[layer.previndex] + 1)
+
+        # only the new layer is needed in full from now on
+        prevlayer.release()
+        dplayers.append(layer)
+
+        # PART 2.4: if the time budget is likely to be exceeded at the current pace, narrow down the search
+        # (the pace is only judged by layers made entirely with the current width)
+        if (maxtime != None and width > 1):
+            now = time.time()
+            if (len(prevlayer.op) <= width and (now - starttime) + (now - layertime) * (dpops.n - 1 - pos) > maxtime):
+                width = max(1, width // 2)
+                minwidth = width
+            layertime = now
+
+    return dplayers, minwidth
+
+
+# get costs of having every operation j after every potential previous operation k (entry [k][j])
+def getdpcosts(prevlayer, dpops):
+    # by default, need to change the tip
+    extracost = np.ones((dpops.n, dpops.n))
+
+    # if the part being added is the same, check if the last well had any parts the next well does not
+    # (other parts added to the last well must also have been added to the next well at the same address)
+    k = dpops.samek
+    j = dpops.samej
+    lastrow = prevlayer.wellrows(k, dpops.well[k]) & dpops.notown
+    nextrow = prevlayer.wellrows(k, dpops.well[j]) & dpops.compat
+    samecost = np.any(lastrow & ~nextrow, axis=1)
+
+    # take into account pipette capacity, IF working with a capacitated problem
+    if (dpops.cap is not None):
+        # if there is no extra space for another aliquot, change tip
+        samecost |= (prevlayer.doses[k] >= dpops.cap[k])
+    extracost[k, j] = samecost
+
+    # cost of the route up to the previous record plus the cost of performing the operation in question
+    dpcosts = prevlayer.bestcost[:, None] + extracost
 
-# get cost of having the given operation after a potential previous one (1 if tip must be changed, 0 if not)
-def getdpcost(rec,maybeprev,dprecs,w,caps):
     # if the operation has already been made, the resultant sequence is impossible
-    if(maybeprev.added[rec.op.well][rec.op.part[0]]==True):
-        return np.inf
-
-    # if the part being added is different, need to change the tip
-    if(rec.op.part!=maybeprev.op.part):
-        extracost=1 # this is the cost of performing the given operation after the previous
-    else:
-        extracost=0
-
-        # check if the last well had any parts the next well does not
-        for i in range(0, len(w[0])):
-            if (w[rec.op.well][i] != rec.op.part):
-                if not (maybeprev.added[maybeprev.op.well][i] == 0 or (w[rec.op.well][i] == w[maybeprev.op.well][i] and maybeprev.added[rec.op.well][i] == 1)):
-                    extracost=1
-
-        # take into account pipette capacity, IF working with a capacitated problem
-        if(caps!=None):
-            # only need to do that if cost is ostensibly 0 and the number of operations is less than the capacity
-            if(extracost==0 and caps[rec.op.part]<=rec.pos):
-                extracost=1 # assume there is no extra space in the tip for another aliquot
-
-                # check if it is actually so; if there is space, tip does not have to be changed
-                checkrec=maybeprev
-                for i in range(0,caps[rec.op.part]-1): # go back for as long as the capacity considerations are relevant
-                    if(checkrec.changed):
-                        extracost=0
-                        break
-                    else:
-                        checkrec=dprecs[checkrec.pos-1][checkrec.previndex] # go to the record before
-
-    # return the cost of the route up to the previous record plus the cost of performing the operation in question
-    return extracost+maybeprev.bestcost
+    dpcosts[prevlayer.isadded(np.arange(len(dpcosts))[:, None], dpops.well, dpops.type)] = np.inf
+    return dpcosts
+
+
+# estimate the memory (in bytes) bounded DP needs: returns the part independent of the width, the part per tip-change
+# candidate record (there are min(preds, width) of them) and the part per record
+# The sizes in bytes per operation were measured with tracemalloc (1536 operations, numpy 2)
+def dp_bounded_memory(dpops, w):
+    n = dpops.n
+    maxpart = max(len(idx) for idx in dpops.bypart) # most operations with the same part
+    # the operations as objects in ops (109 bytes each), the list of them in fin (8) and the operations in array form (115);
+    # the layers of the width-1 pass and of the full one, as each layer kept for reconstruction has the overhead of its
+    # object and arrays (450)
+    base = n * (109 + 8 + 115) + 2 * n * 450
+    # tip-change candidates, n for each candidate record: k, j, cost, the mask of possible ones, the bit positions and
+    # bytes read to find it, the sorting order and the copies made when joining them with the tip-keeping ones (82)
+    percand = n * 82
+    # two complete layers alive at a time (packed well states, op, bestcost, previndex, changed, doses);
+    # op, previndex and changed kept in every layer for reconstruction;
+    # candidates keeping the tip (k, j, cost, well numbers, masks of well states and same parts, and the bit positions
+    # and bytes read while unpacking the well states)
+    perrec = (2 * (-(-w.n_wells * w.n_types // 8) + 8 + 8 + 4 + 1 + 4) + n * (8 + 4 + 1)
+              + maxpart * (8 * 4 + 36 * w.n_types + 1))
+    return base, percand, perrec
+
+
+# bounded DP: for the records of the previous layer (sorted by cost), get the best records for the next position
+def getbestrecs(prevlayer, dpops, w, width, preds):
+    prevops = prevlayer.op
+
+    # PART 1: changing the tip, the best previous record is simply the cheapest one where the operation wasn't made yet,
+    # so looking among the preds cheapest records is enough
+    k = np.repeat(np.arange(min(preds, len(prevops))), dpops.n)
+    j = np.tile(np.arange(dpops.n), min(preds, len(prevops)))
+    cost = prevlayer.bestcost[k] + 1
+
+    # PART 2: the tip may be kept if the operation has the same part as the previous one
+    samek = np.concatenate([np.full(len(dpops.bypart[dpops.pid[op]]), i) for i, op in enumerate(prevops)])
+    samej = np.concatenate([dpops.bypart[dpops.pid[op]] for op in prevops])
+    lastwell = dpops.well[prevops[samek]]
+    lastrow = prevlayer.wellrows(samek, lastwell) & (np.arange(w.n_types) != dpops.type[samej][:, None])
+    nextrow = prevlayer.wellrows(samek, dpops.well[samej]) & (w.wmat[dpops.well[samej]] == w.wmat[lastwell])
+    samecost = np.any(lastrow & ~nextrow, axis=1)
+    if (dpops.cap is not None):
+        samecost |= (prevlayer.doses[samek] >= dpops.cap[samej])
+    k = np.concatenate((k, samek))
+    j = np.concatenate((j, samej))
+    cost = np.concatenate((cost, prevlayer.bestcost[samek] + samecost))
+
+    # PART 3: if the operation has already been made, the resultant sequence is impossible
+    possible = ~prevlayer.isadded(k, dpops.well[j], dpops.type[j])
+    k = k[possible]
+    j = j[possible]
+    cost = cost[possible]
+
+    # PART 4: for each operation, find the best previous record (the earliest one in case of a tie)
+    order = np.lexsort((k, cost, j))
+    first = order[np.flatnonzero(np.r_[True, j[order][1:] != j[order][:-1]])]
+    k = k[first]
+    j = j[first]
+    cost = cost[first]
+    changed = (prevlayer.bestcost[k] < cost)
+
+    # PART 5: keep the width best records; among equally cheap ones, prefer those keeping the tip
+    keep = np.lexsort((j, changed, cost))[:width]
+    layer = DPlayer(0, w) # columns are filled in below
+    layer.op = j[keep]
+    layer.previndex = k[keep].astype(np.int32)
+    layer.bestcost = cost[keep]
+    layer.changed = changed[keep]
+    return layer
 
 
 # ----------- MAIN FUNCTION (TESTING ONLY) ------------
@@ -158,7 +372,7 @@ def main():
          [(0, 1), (1, 2), (2, 2), (3, 2)],
          [(0, 2), (1, 3), (2, 1), (3, 1)]]
 
-    w = wgenerator(18, 6, 6, 3, 4)
+    w = wgenerator(96, 6, 6, 3, 4)
 
     # generate required volumes (for testing). Values taken from a real instance of Start-Stop assembly
     ss = []
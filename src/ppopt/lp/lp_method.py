@@ -14,14 +14,24 @@ The resultant sequence of operations is recorded in a class Oper list fin.
 """
 
 from ppopt.auxil import *
-from ppopt.lp.lp_reorder import reorder_nns, reorder_greedy
+from ppopt.lp.lp_reorder import reorder_nns, reorder_greedy, Dupdate, Dselect
 from ppopt.lp.lp_solver import *
+from concurrent.futures import ProcessPoolExecutor
+import time
+import os
 
 
 # ---------------------SOLVER FUNCTION----------------------------------
-# solves the problem
-def lp_method(w, fin, reord, caps, maxtime, solver=None):
+# solves the problem; if workers is given, subsets are solved in parallel by that many processes
+# if deadline is given, the whole method is to finish within deadline seconds (maxtime is then ignored, and the 'nns'
+# and 'greedy' reorderings estimate the subsets' costs instead of solving their LP problems - see lp_reorder.py)
+def lp_method(w, fin, reord, caps, maxtime, solver=None, workers=None, deadline=None):
     # PART 1: initial preparations
+    starttime = time.time()
+
+    # PART 1.0: compile the input (w can also be given as a Problem)
+    w = to_problem(w, caps)
+    caps = w.caps
 
     # PART 1.1: get the subsets
     # (each 'subset' contains all additions of a given part; number of parts = number of subsets)
@@ -29,9 +39,10 @@ def lp_method(w, fin, reord, caps, maxtime, solver=None):
     w_to_subsets(w, subsets)
 
     # PART 1.2: get the matrix of distances for the graph of wells
-    D = np.zeros((len(w), len(w)))  # initialise
-    for i in range(0, len(D)):  # forbid going from a node to itself by setting a very high cost
-        D[i][i] = 1000 * len(D)
+    # (all edge costs are 0 or 1, so a compact integer type is used; only the zero-cost edges can be chosen, so going
+    # from a node to itself is forbidden by setting the cost to 1)
+    D = np.zeros((w.n_wells, w.n_wells), dtype=np.int8)  # initialise
+    np.fill_diagonal(D, 1)
 
     # PART 1.3: set default maximum optimisation time if none specified
     if(maxtime==None):
@@ -48,21 +59,64 @@ def lp_method(w, fin, reord, caps, maxtime, solver=None):
             leastout(subsets, w)
         elif (reord == 'sametogether'):  # ...sametogether
             sametogether(subsets, w)
-        elif((reord[0:3]=='nns') or (reord=='greedy')):  # (various state-space reorderings)
+        elif((reord[0:3]=='nns') or (reord[0:6]=='greedy')):  # (various state-space reorderings)
+            # the subsets' costs are found by solving their LP problems or, if ' surrogate' is added, estimated quickly
+            # (with a deadline, the costs are always estimated, as solving LP problems would take unpredictably long)
+            if (reord[-10:] == ' surrogate'):
+                scoring = 'surrogate'
+                reord = reord[:-10]
+            elif (deadline != None):
+                scoring = 'surrogate'
+            else:
+                scoring = 'exact'
             origsubs = subsets.copy()
             subsets = []
             if (reord == 'nns'):  # ...nearest neighbour algorithm (i.e. nns depth 1)
-                reorder_nns(origsubs, subsets, D.copy(), 1, caps)
+                reorder_nns(origsubs, subsets, D.copy(), 1, caps, scoring)
             elif (reord == 'nns depth 2'):  # ...nns depth 2
-                reorder_nns(origsubs, subsets, D.copy(), 2, caps)
+                reorder_nns(origsubs, subsets, D.copy(), 2, caps, scoring)
             elif (reord == 'greedy'):  # ...greedy tree search
-                reorder_greedy(origsubs, subsets, D.copy(), 'countall',caps)
+                reorder_greedy(origsubs, subsets, D.copy(), 'countall', caps, scoring)
 
     # PART 3: implement the algorithm
-    for i in range(0, len(subsets)):
-        #print(str(i)+' of '+str(len(subsets))+' parts')  # uncomment if need to track the progress
-        # call single-subset LP solver for each subset
-        singlesub(subsets[i], D, fin, caps[subsets[i].part],maxtime,solver)
+    if ((workers == None or workers == 1) and deadline == None):
+        for i in range(0, len(subsets)):
+            #print(str(i)+' of '+str(len(subsets))+' parts')  # uncomment if need to track the progress
+            # call single-subset LP solver for each subset
+            singlesub(subsets[i], D, fin, caps[subsets[i].part],maxtime,solver)
+    else:
+        # the update of D does not depend on the solutions, so all subgraphs can be selected beforehand
+        subDs = []
+        for i in range(0, len(subsets)):
+            subDs.append(get_subD(subsets[i], D))
+        subcaps = [caps[subset.part] for subset in subsets]
+
+        # PART 3.1: solve the single-subset problems in parallel
+        if (workers != None and workers != 1):
+            # with a deadline, the subsets are split between the workers beforehand, and each worker solves its own
+            # ones one by one, sharing the time left until the deadline between them
+            # (workers beyond the number of CPU cores would only slow each other down, so no more are used)
+            if (deadline != None):
+                bundles = split_between_workers(subDs, min(workers, os.cpu_count() or 1))
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    bundlesols = list(pool.map(solve_subDs_until, [[subDs[i] for i in bundle] for bundle in bundles],
+                                               [[subcaps[i] for i in bundle] for bundle in bundles],
+                                               [starttime + deadline] * len(bundles), [solver] * len(bundles)))
+                sols = [None] * len(subsets)
+                for b in range(0, len(bundles)):
+                    for i in range(0, len(bundles[b])):
+                        sols[bundles[b][i]] = bundlesols[b][i]
+            else:
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    sols = list(pool.map(solve_subD, subDs, subcaps, [maxtime] * len(subsets), [solver] * len(subsets)))
+
+        # PART 3.2: solve the single-subset problems one by one within the deadline
+        else:
+            sols = solve_subDs_by_deadline(subDs, subcaps, deadline - (time.time() - starttime), solver)
+
+        # record the solutions in the original order of subsets
+        for i in range(0, len(subsets)):
+            record_sol(subsets[i], sols[i], fin, subcaps[i])
 
     # PART 4: fix redundant tip changes
     #fix_redundant(fin,w,caps)
@@ -71,60 +125,109 @@ def lp_method(w, fin, reord, caps, maxtime, solver=None):
 # ------------------SOLVER FOR ONE SUBSET-------------------------------
 # creates and solves an LP problem for
 def singlesub(subset, D, fin, cap, maxtime, solver):
-    # PART 1: initial preparations
-    # get length to avoid calling len too often
-    sublen = len(subset.wells)
+    # PART 1: select the submatrix and update D
+    subD = get_subD(subset, D)
 
-    # initialise subD, the distance matrix for the subgraph
-    subD = np.zeros((sublen + 1,sublen + 1)) # an extra 0 node is needed for tspy compatibility
-    subD[0][0]=len(D)*1000
+    # PART 2: solve LP problem for the subset
+    sol = solve_subD(subD, cap, maxtime, solver)
 
-    # PART 2: select the submatrix and update D
-    """
-    For every well belonging to the subset (given by subset.wells[i_well]), we consider all outgoing edges
-    (given by D[subset.wells[i_well]][j_D]).
-    If the edge arrives at another subset well (given by subset.wells[current_well]), we select it into the subgraph,
-    i.e. we get its value into subD[i_well+1][current_well].
-    If the edge arrives into a well not in the subset, its cost in D must be updated to be 1.
-    """
-    for i_well in range(0, sublen):
-        current_well = 0
-        for j_D in range(0, len(D)):
-            if (j_D == subset.wells[current_well]):
-                subD[i_well + 1][current_well + 1] = D[subset.wells[i_well]][j_D] # selecting the edge
-                if (current_well < sublen - 1):
-                    current_well += 1
-            else:
-                D[subset.wells[i_well]][j_D] = 1  # updating D
+    # PART 3: record operations in fin
+    record_sol(subset, sol, fin, cap)
 
-    # PART 3: solve LP problem for the subset
 
-    # 3a): capacitated problem
+# select the distance matrix for the subgraph of the subset's wells, and update D
+# (the edges from the subset's wells to other wells must have their cost in D updated to be 1)
+def get_subD(subset, D):
+    subD = Dselect(D, subset)
+    Dupdate(D, subset)
+    return subD
+
+
+# solve the LP problem for a subgraph with distance matrix subD
+# (returns the chain coverage for a capacitated problem, the TSP tour otherwise)
+def solve_subD(subD, cap, maxtime, solver):
+    # a): capacitated problem
     if(cap!=None):
         # get the chain coverage
         if (len(subD) == 2):
-            chains = [[1]]
+            return ChainCover([[1]], 'OPTIMAL', 1)
         else:
-            chains = lp_cap(subD, cap, maxtime, solver)
+            return lp_cap(subD, cap, maxtime, solver)
 
-        # record operations in fin
-        for chain in chains:
+    # b): non-capacitated problem
+    else:
+        # get the TSP tour
+        if (len(subD) == 2):
+            return [0,1]
+        else:
+            return tsp_lp_gurobi(subD)
+
+
+# solve the LP problems for subgraphs with distance matrices subDs and capacities subcaps, all within timeleft seconds
+# First, all capacitated problems are solved by bipartite matching (or exactly, if small enough), which takes little time.
+# Then the solutions not known to be optimal are improved by the solver: each problem is given a share of the time left
+# proportional to its weight, so time unused by problems solved early is passed on to the rest; if the share is too short
+# to run the solver, the matching solution is kept
+def solve_subDs_by_deadline(subDs, subcaps, timeleft, solver):
+    endtime = time.time() + timeleft
+
+    # PART 1: get the quick solutions (non-capacitated problems are all left to the TSP solver)
+    sols = [None] * len(subDs)
+    for i in range(0, len(subDs)):
+        if (subcaps[i] != None):
+            sols[i] = solve_subD(subDs[i], subcaps[i], 0, 'matching')
+    if (solver == 'matching'):
+        return sols
+
+    # PART 2: improve the solutions with the solver
+    weights = [subD_weight(subDs[i]) if (sols[i] == None or not sols[i].optimal()) else 0 for i in range(0, len(subDs))]
+    weightleft = sum(weights)
+    for i in range(0, len(subDs)):
+        if (sols[i] != None and weights[i] == 0):
+            continue
+        share = max(endtime - time.time(), 0) * weights[i] / max(weightleft, 1)
+        weightleft -= weights[i]
+        if (sols[i] == None or budget_solver(weights[i], share, solver) != 'matching'):
+            sol = solve_subD(subDs[i], subcaps[i], share, solver)
+            if (sols[i] == None or len(sol) <= len(sols[i])):
+                sols[i] = sol
+    return sols
+
+
+# same as solve_subDs_by_deadline, but the deadline is given as the moment endtime (so that the time spent starting a
+# worker process is taken into account)
+def solve_subDs_until(subDs, subcaps, endtime, solver):
+    return solve_subDs_by_deadline(subDs, subcaps, endtime - time.time(), solver)
+
+
+# split the subgraphs with distance matrices subDs between workers so that their loads are balanced: the heaviest
+# problems go first, each to the worker with the least load so far (the load of a problem is its weight plus its size,
+# as even problems of zero weight take some time). Returns the lists of problem indices for each worker, in original order
+def split_between_workers(subDs, workers):
+    loads = [subD_weight(subD) + len(subD) for subD in subDs]
+    bundles = [[] for b in range(0, workers)]
+    bundleloads = np.zeros(workers)
+    for i in sorted(range(0, len(subDs)), key=lambda i: -loads[i]):
+        b = int(np.argmin(bundleloads))
+        bundles[b].append(i)
+        bundleloads[b] += loads[i]
+    return [sorted(bundle) for bundle in bundles if (len(bundle) != 0)]
+
+
+# record the operations given by the subset's LP problem solution sol in fin
+def record_sol(subset, sol, fin, cap):
+    # a): capacitated problem
+    if(cap!=None):
+        for chain in sol:
             fin.append(Oper(subset.part, subset.wells[chain[0] - 1]))
             fin[-1].changed=True
             for i in range(1,len(chain)):
                 fin.append(Oper(subset.part, subset.wells[chain[i]-1]))
 
-    # 3b): non-capacitated problem
+    # b): non-capacitated problem
     else:
-        # get the TSP tour
-        if (len(subD) == 2):
-            tour = [0,1]
-        else:
-            tour = tsp_lp_gurobi(subD)
-
-        # record operations in fin
-        for i in range(1,len(tour)):
-            fin.append(Oper(subset.part, subset.wells[tour[i]-1]))
+        for i in range(1,len(sol)):
+            fin.append(Oper(subset.part, subset.wells[sol[i]-1]))
 
 
 # -----------------CHECK & FIX REDUNDANT TIP CHANGES---------------------------
@@ -132,37 +235,13 @@ def singlesub(subset, D, fin, cap, maxtime, solver):
 # This program fixes them by calculating tip changes of the same operation list independently
 
 def fix_redundant(fin,w,caps):
-    # PART 1: initial preparations
-
-    # make a copy, reset its tip change indicators
-    cfin = deepcopy(fin)
-    for i in range(0, len(cfin)):
-        cfin[i].changed = False
-
-    # create the array added (tells which parts were added to which well)
-    added = np.zeros((len(w), len(w[0])), dtype=bool)  # added[i][j]==True if part at address j in well i has been added
-
-    # PART 2: get the cost
-
-    # PART 2.1: the first operation in cfin
-    cost = 1  # beginning the distribuiton => new tip taken
-    cfin[0].changed = True  # indicate the tip's been changed
-    added[cfin[0].well][cfin[0].part[0]] = 1  # indicate the part's been added
-
-    # PART 2.2: all other operations
-    for i in range(1, len(cfin)):
-        one_cost = cost_func_with_w(cfin[0:i], cfin[i], w, added, caps)  # get operation cost
-        cost += one_cost  # add operation cost
-
-        added[cfin[i].well][cfin[i].part[0]] = 1  # indicate the part's been added
-        # if the tip's been changed (operation cost 1), indicate that
-        if (one_cost == 1):
-            cfin[i].changed = True
+    # PART 1: get the cost and the operations whose tip change indicators differ, both calculated independently
+    cost, different = verify_plan(fin, w, caps)
 
-    # PART 3: if the independently-determined tip changes are better, use this better operation list instead
+    # PART 2: if the independently-determined tip changes are better, use them instead
     if(cost<route_cost(fin)):
-        for i in range(0,len(fin)):
-            fin[i]=cfin[i]
+        for diffop in different:
+            fin[int(diffop[1])].changed = diffop[0].changed
 
 # ---------------------DISPLAYING SUBSETS-------------------------------
 def disp(subsets, D):
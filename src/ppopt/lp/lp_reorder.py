@@ -8,10 +8,11 @@ from tspy import TSP
 from tspy.solvers.utils import get_cost
 from tspy.solvers import TwoOpt_solver
 
-from ppopt.lp.lp_solver import lp_cap
+from ppopt.lp.lp_solver import lp_cap, match_lp_cap
 
 # Nearest Neighbour tree search; the depth argument determines search depth
-def reorder_nns(origsubs, subsets, D, depth,caps):
+# the scoring argument determines how subsets' costs are found: 'exact' (solving their LP problems) or 'surrogate'
+def reorder_nns(origsubs, subsets, D, depth, caps, scoring='exact'):
     # PART 1: initial preparations
     # set maximum optimisation time for the cost function (less than default for quicker searching)
     global maxtime
@@ -20,45 +21,48 @@ def reorder_nns(origsubs, subsets, D, depth,caps):
     # get the total number of subsets
     all_subsets = len(origsubs)
 
+    # initialise the cache of subsets' costs
+    costs = CostCache(origsubs, scoring)
+
 
     # PART 2: reorder the subsets
 
     # PART 2.1: the first subset
     subsets.append(origsubs[0])
     origsubs.pop(0)
-    Dupdate(D, subsets[-1])
+    Dupdate(D, subsets[-1], costs)
 
     # PART 2.2: all other subsets
     while (len(subsets) < all_subsets):
         # get next subset
-        nextsub = reorder_nns_oneiter(origsubs, subsets, D.copy(), 1, depth, caps)
+        nextsub = reorder_nns_oneiter(origsubs, subsets, D.copy(), 1, depth, caps, costs)
 
         subsets.append(origsubs[nextsub]) # record next subset
         origsubs.pop(nextsub) # remove next subset from the list of unvisited subsets
-        Dupdate(D, subsets[-1]) # update D
+        Dupdate(D, subsets[-1], costs) # update D
 
 
 # single iteration of NNs
-def reorder_nns_oneiter(origsubs, subsets, D, curdepth, depth, caps):
+def reorder_nns_oneiter(origsubs, subsets, D, curdepth, depth, caps, costs):
     # PART 1: determine the potential cost of each possible operation
     potcost = [] # initialise list of potential costs
     for i in range(0, len(origsubs)):
         # get cost of choosing this susbset
-        potcost.append(solveforcost(origsubs[i], D,caps[origsubs[i].part]))
+        potcost.append(costs.get(origsubs[i], D, caps[origsubs[i].part]))
         # go deeper (if needed and possible)
         if (curdepth < depth and len(origsubs) != 1):
             # change D and inputs as if the current subset was chosen
-            werenew = Dupdate(D, origsubs[i])
+            werenew = Dupdate(D, origsubs[i], costs)
             subsets.append(origsubs[i])
             origsubs.pop(i)
 
             # call the single-iteration function again
-            potcost[i] += reorder_nns_oneiter(origsubs, subsets, D, curdepth + 1, depth,caps)
+            potcost[i] += reorder_nns_oneiter(origsubs, subsets, D, curdepth + 1, depth, caps, costs)
 
             # change the inputs back
             origsubs.insert(i, subsets[-1])
             subsets.pop()
-            Drollback(D, werenew)
+            Drollback(D, werenew, costs)
 
     # PART 2: act according to the determined costs
     # if the current depth is 1, return the entry with the least potential cost
@@ -72,7 +76,8 @@ def reorder_nns_oneiter(origsubs, subsets, D, curdepth, depth, caps):
 
 
 # Greedy search; the heur argument determines which heuristic is used
-def reorder_greedy(origsubs, subsets, D, heur, caps):
+# the scoring argument determines how subsets' costs are found: 'exact' (solving their LP problems) or 'surrogate'
+def reorder_greedy(origsubs, subsets, D, heur, caps, scoring='exact'):
     # PART 1: initial preparations
     # set maximum optimisation time for the cost function  (less than default for quicker searching)
     global maxtime
@@ -81,31 +86,37 @@ def reorder_greedy(origsubs, subsets, D, heur, caps):
     # get the total number of subsets
     all_subsets = len(origsubs)
 
+    # initialise the cache of subsets' costs
+    costs = CostCache(origsubs, scoring)
+
+    # get the sum of all edge costs in D, which is then kept up to date
+    tally = Dsum(D)
+
 
     # PART 2: reorder the subsets
 
     # PART 2.1: the first subset
     subsets.append(origsubs[0])
     origsubs.pop(0)
-    Dupdate(D, subsets[0])
+    tally += len(Dupdate(D, subsets[0], costs)) # each edge altered by Dupdate has its cost increased by 1
 
     # PART 2.2: all other subsets
     while (len(subsets) < all_subsets):
         # get next subset
-        nextop = reorder_greedy_onestep(origsubs, subsets, D, heur,caps)
+        nextop = reorder_greedy_onestep(origsubs, subsets, D, heur, caps, costs, tally)
 
         subsets.append(origsubs[nextop]) # record next subset
         origsubs.pop(nextop) # remove next subset from the list of unvisited subsets
-        Dupdate(D, subsets[-1]) # update D
+        tally += len(Dupdate(D, subsets[-1], costs)) # update D and the sum of its edge costs
 
 
-# single step of greedy search
-def reorder_greedy_onestep(origsubs, subsets, D, heur,caps):
+# single step of greedy search (tally is the sum of all edge costs in D)
+def reorder_greedy_onestep(origsubs, subsets, D, heur, caps, costs, tally):
     # PART 1: determine the potential cost+heuristic of each possible operation
     potcost = [] # intialise the list of potetntial values
     for i in range(0, len(origsubs)):
         # PART 1.1: cost function component
-        potcost.append(solveforcost(origsubs[i], D,caps[origsubs[i].part]))
+        potcost.append(costs.get(origsubs[i], D, caps[origsubs[i].part]))
 
         # PART 1.2: heuristic component
         # pretend the current subset is included in the route (D NOT updated! As some heuristics MIGHT need unupdated D)
@@ -113,7 +124,7 @@ def reorder_greedy_onestep(origsubs, subsets, D, heur,caps):
         origsubs.pop(i)
 
         # get the heuristic value
-        potcost[-1] += h_tree(subsets, origsubs, D.copy(), heur)
+        potcost[-1] += h_tree(subsets, origsubs, D, heur, tally)
 
         # undo including the current subset into the route
         origsubs.insert(i, subsets[-1])
@@ -124,17 +135,17 @@ def reorder_greedy_onestep(origsubs, subsets, D, heur,caps):
 
 # heursiric function
 # complete = subsets currently in route, remaining = subsets not in route
-def h_tree(inroute, remaining, D, heur):
+# tally is the sum of all edge costs in D (found from D if not given); D is returned unchanged
+def h_tree(inroute, remaining, D, heur, tally=None):
     # countall: h is the sum of all edge costs multiplied by the number of iterations left
     if (heur == 'countall'):
-        Dupdate(D, inroute[-1]) # update D for current subset (as it was not updated before)
+        if (tally == None):
+            tally = Dsum(D)
 
-        # sum all edge costs
-        tally = 0
-        for i in range(0, len(D)):
-            for j in range(0, len(D)):
-                if (i != j):
-                    tally += D[i][j]
+        # update D for current subset (as it was not updated before) - each altered edge's cost increases by 1
+        werenew = Dupdate(D, inroute[-1])
+        tally += len(werenew)
+        Drollback(D, werenew)
 
         # calculate the value of h
         answer = tally * len(remaining)
@@ -142,64 +153,123 @@ def h_tree(inroute, remaining, D, heur):
 
 
 # ----------------------------AUXILIARIES FOR TREE SEARCH---------------------------
-# update D according to the subset
-def Dupdate(D, subset):
-    werenew = [] # created the list of altered edges
-    sublen = len(subset.wells) # get subgraph length to avoid calling len too often
+# Cache of the subsets' costs found by solveforcost for the current D
+# A subset's cost only depends on the edges of D between its own wells, so when Dupdate alters some edges, only the costs
+# of subsets containing both ends of one of them are dropped. The dropped costs are stashed for Drollback to restore
+class CostCache:
+    # initialisation
+    def __init__(self, subsets, scoring='exact'):
+        self.scoring = scoring  # how the costs are found (see solveforcost)
+        self.costs = {}  # cost of each subset (given by its part) for the current D
+        self.stash = []  # for each Dupdate not yet rolled back, the costs of the subsets whose edges it altered
+        self.wellsets = {}  # set of wells of each subset
+        self.partsofwell = {}  # subsets (given by their parts) containing each well
+        for subset in subsets:
+            self.wellsets[subset.part] = set(subset.wells)
+            for well in subset.wells:
+                self.partsofwell.setdefault(well, []).append(subset.part)
+
+    # get the cost of a subset, calling solveforcost if it is not known for the current D
+    def get(self, subset, D, cap):
+        if (subset.part not in self.costs):
+            self.costs[subset.part] = solveforcost(subset, D, cap, self.scoring)
+        return self.costs[subset.part]
+
+    # drop the costs of subsets affected by the edges in werenew, stashing them in case D is rolled back
+    def invalidate(self, werenew):
+        dropped = {}
+        # go through the edges grouped by their start well (Dupdate lists them start well by start well)
+        if (len(werenew) != 0):
+            for group in np.split(werenew, np.flatnonzero(np.diff(werenew[:, 0])) + 1):
+                ends = set(group[:, 1].tolist())
+                for part in self.partsofwell.get(int(group[0, 0]), []):
+                    if (part not in dropped and not self.wellsets[part].isdisjoint(ends)):
+                        dropped[part] = self.costs.pop(part, None)
+        self.stash.append(dropped)
+
+    # restore the costs dropped by the latest invalidation (costs found for the updated D are discarded)
+    def rollback(self):
+        dropped = self.stash.pop()
+        for part in dropped.keys():
+            if (dropped[part] != None):
+                self.costs[part] = dropped[part]
+            else:
+                self.costs.pop(part, None)
+
 
+# update D according to the subset; if the cache of costs is given, the costs that may have changed are dropped from it
+# returns the altered edges as an array whose rows are (start well, end well)
+def Dupdate(D, subset, costs=None):
     """
-    For every well belonging to the subset (given by subset.wells[i_well]), we consider all outgoing edges
-    (given by D[subset.wells[i_well]][j_D]).
+    For every well belonging to the subset, we consider all outgoing edges (i.e. the well's row in D).
     If the edge arrives to a well not in the subset, its cost in D must be updated to be 1 (if it wasn't 1 already).
     """
-    for i_well in range(0, sublen):
-        current_well = 0
-        for j_D in range(0, len(D)):
-            if (j_D == subset.wells[current_well]):
-                if (current_well < sublen - 1):
-                    current_well += 1
-            else:
-                if (D[subset.wells[i_well]][j_D] != 1):
-                    D[subset.wells[i_well]][j_D] = 1
-                    werenew.append([subset.wells[i_well], j_D]) # record which edge's cost was altered
+    wells = np.asarray(subset.wells)
+    others = np.ones(len(D), dtype=bool) # mask of wells not in the subset
+    others[wells] = False
+
+    # find the edges that need altering, i.e. ones from the subset to other wells whose cost isn't 1 yet
+    rows, cols = np.nonzero(D[wells] != 1)
+    outside = others[cols]
+    werenew = np.column_stack((wells[rows[outside]], cols[outside]))
+
+    # alter them
+    D[werenew[:, 0], werenew[:, 1]] = 1
+
+    # update the cache of costs
+    if (costs != None):
+        costs.invalidate(werenew)
 
     # return the list of all altered edges
     return werenew
 
 
-# roll D back to before the Dupdate call
-def Drollback(D, werenew):
-    for i in range(0, len(werenew)):
-        D[werenew[i][0]][werenew[i][1]] -= 1
+# select the distance matrix for the subgraph of the subset's wells (an extra 0 node is added for tspy compatibility)
+def Dselect(D, subset):
+    wells = np.asarray(subset.wells)
+    subD = np.zeros((len(wells) + 1, len(wells) + 1), dtype=D.dtype)
+    subD[1:, 1:] = D[np.ix_(wells, wells)]
+    subD[0][0] = 1 # forbid going from a node to itself
+    return subD
+
 
+# sum of all edge costs in D (excluding the forbidden edges from a node to itself)
+def Dsum(D):
+    return int(np.sum(D) - np.trace(D))
 
-# obtain a solution for given subset to determine its cost for sure
-def solveforcost(subset, D, cap):
+
+# roll D back to before the Dupdate call (given the same cache of costs as Dupdate)
+def Drollback(D, werenew, costs=None):
+    D[werenew[:, 0], werenew[:, 1]] -= 1
+
+    # restore the cache of costs
+    if (costs != None):
+        costs.rollback()
+
+
+# obtain a solution for given subset to determine its cost for sure (scoring='exact'),
+# or estimate the cost quickly by finding a chain cover with bipartite matching (scoring='surrogate')
+def solveforcost(subset, D, cap, scoring='exact'):
     # PART 1: initial preparations
     # get length to avoid calling len too often
     sublen = len(subset.wells)
 
-    # initialise the subset's matrix subD
-    subD = np.zeros((sublen + 1, sublen + 1))  # an extra 0 node is needed for tspy compatibility
-
-    # PART 2: select submatrix and update D as if problem for the subset is already solved
-    """
-    For every well belonging to the subset (given by subset.wells[i_well]), we consider all outgoing edges
-    (given by D[subset.wells[i_well]][j_D]).
-    If the edge arrives at another subset well (given by subset.wells[current_well]), we select it into the subgraph,
-    i.e. we write its cost into subD[i_well+1][current_well].
-    """
-    for i_well in range(0, sublen):
-        current_well = 0
-        for j_D in range(0, len(D)):
-            if (j_D == subset.wells[current_well]):
-                subD[i_well + 1][current_well + 1] = D[subset.wells[i_well]][j_D]
-                if (current_well < sublen - 1):
-                    current_well += 1
+    # PART 2: select the submatrix
+    subD = Dselect(D, subset)
 
     # PART 3: solve TSP for the subset and record costs
+    # PART 3.0: if only an estimate is needed, cover the wells with chains found by maximum matching, split to fit the
+    # capacity (no capacity limit for non-capacitated problems) - this takes polynomial time, without calling a solver
+    if (scoring == 'surrogate'):
+        if (len(subD) == 2):
+            cost = 1
+        elif (cap != None):
+            cost = len(match_lp_cap(subD, cap, repair=False))
+        else:
+            cost = len(match_lp_cap(subD, sublen, repair=False))
+
     # 3a): capacitated problem
-    if (cap!=None):
+    elif (cap!=None):
         # get the chain coverage
         if (len(subD) == 2):
             chains = [[1]]
@@ -213,7 +283,7 @@ def solveforcost(subset, D, cap):
     else:
         # get the TSP tour using the tspy package
         tsp = TSP()
-        tsp.read_mat(subD)
+        tsp.read_mat(subD.astype(float))
         two_opt = TwoOpt_solver(initial_tour='NN', iter_num=100)
         tour = tsp.get_approx_solution(two_opt)
 
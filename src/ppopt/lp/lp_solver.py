@@ -4,6 +4,10 @@
 # v0.1.10, 30.5.21
 
 from itertools import combinations,product
+from collections import OrderedDict
+import numpy as np
+import time
+import os
 
 # IMPORT GUROBI SOLVER  (comment out if not using)
 import gurobipy as gp
@@ -11,6 +15,94 @@ from gurobipy import GRB
 
 # IMPORT OR-TOOLS (CP-SAT) SOLVER
 from ortools.linear_solver import pywraplp
+from ortools.sat.python import cp_model
+
+
+#-------------------SOLVER SESSIONS--------------------
+# Starting a GUROBI environment or creating an OR-tools solver takes long compared to solving small problems, so
+# one of each is kept per process and reused by all calls
+# The TSP model's variables and constraints only depend on the number of nodes, so one model skeleton is kept per size and
+# just given new edge lengths. The capacitated models only have variables for zero-length edges, so their structure
+# changes with every problem; instead, whole solutions of problems with the same zero edges are cached by lp_cap
+sessions = {'pid': None, 'gurobi env': None, 'ortools solver': None, 'cp-sat solver': None, 'tsp models': {}}
+
+# time spent setting the problems up and solving them, for each solver
+solve_stats = {}
+
+
+# get the session objects for this process (processes forked by lp_method can't share them with the parent)
+def get_sessions():
+    if (sessions['pid'] != os.getpid()):
+        sessions['pid'] = os.getpid()
+        sessions['gurobi env'] = None
+        sessions['ortools solver'] = None
+        sessions['cp-sat solver'] = None
+        sessions['tsp models'] = {}
+    return sessions
+
+
+# get the GUROBI environment, starting it if needed
+def get_gurobi_env():
+    sess = get_sessions()
+    if (sess['gurobi env'] == None):
+        # set output flag to 0 to prevent GUROBI from printing out logs
+        env = gp.Env(empty=True)
+        env.setParam('OutputFlag', 0)
+        env.start()
+        sess['gurobi env'] = env
+    return sess['gurobi env']
+
+
+# get the GUROBI TSP model skeleton for a given number of nodes (edge variables and degree constraints), building it if needed
+def get_tsp_model(size):
+    sess = get_sessions()
+    if (size not in sess['tsp models']):
+        m = gp.Model(env=get_gurobi_env())
+        nodes = list(range(0, size))
+
+        # create a boolean matrix indicating the trip (commonly known as X in literature); edge lengths are set later
+        vars = m.addVars([(i, j) for i, j in product(nodes, nodes) if i != j], vtype=GRB.BINARY, name='e')
+
+        # add initial constraints
+        m.addConstrs(vars.sum(c,'*') == 1 for c in nodes)  # each node has 1 incoming edge
+        m.addConstrs(vars.sum('*',c) == 1 for c in nodes)  # each node has 1 outgoing edge
+
+        m._vars = vars
+        m.Params.lazyConstraints = 1
+        sess['tsp models'][size] = m
+    return sess['tsp models'][size]
+
+
+# get an empty OR-tools solver, creating it if needed
+def get_ortools_solver():
+    sess = get_sessions()
+    if (sess['ortools solver'] == None):
+        sess['ortools solver'] = pywraplp.Solver('CP-SAT_Solve',pywraplp.Solver.SAT_INTEGER_PROGRAMMING)
+    else:
+        sess['ortools solver'].Clear() # remove the previous problem's variables and constraints
+    return sess['ortools solver']
+
+
+# get the CP-SAT solver, creating it if needed
+def get_cpsat_solver():
+    sess = get_sessions()
+    if (sess['cp-sat solver'] == None):
+        sess['cp-sat solver'] = cp_model.CpSolver()
+    return sess['cp-sat solver']
+
+
+# record the time spent on a problem by the given solver: setting it up from t0 to t1, solving from t1 to t2
+def record_times(solver, t0, t1, t2):
+    if (solver not in solve_stats):
+        solve_stats[solver] = {'calls': 0, 'setup': 0.0, 'solve': 0.0}
+    solve_stats[solver]['calls'] += 1
+    solve_stats[solver]['setup'] += t1 - t0
+    solve_stats[solver]['solve'] += t2 - t1
+
+
+# reset the time statistics
+def solve_stats_clear():
+    solve_stats.clear()
 
 
 #-------------------GUROBI: TSP SOLVER (NON-CAPACITATED PROBLEM)--------------------
@@ -18,10 +110,7 @@ from ortools.linear_solver import pywraplp
 #solver
 def tsp_lp_gurobi(D):
     # PART 0: technical GUROBI works
-    # set output flag to 0 to prevent GUROBI from printing out logs
-    env = gp.Env(empty=True)
-    env.setParam('OutputFlag', 0)
-    env.start()
+    t0 = time.time()
 
 
     # PART 1: initial preparations
@@ -35,28 +124,26 @@ def tsp_lp_gurobi(D):
     # PART 1.2: convert distance matrix into the dictionary format used by gurobi
     dist = {(i, j): D[i][j] for i, j in product(nodes, nodes) if i != j}
 
-    # PART 1.3: create the gurobi model
-    m = gp.Model(env=env)
-
-    # PART 1.4: create a boolean matrix indicating the trip (commonly known as X in literature)
-    vars = m.addVars(dist.keys(), obj=dist, vtype=GRB.BINARY, name='e')
+    # PART 1.3: get the gurobi model for this number of nodes (with the trip matrix X and the degree constraints)
+    m = get_tsp_model(len(nodes))
+    vars = m._vars
 
 
-    # PART 2: add initial constraints
-    m.addConstrs(vars.sum(c,'*') == 1 for c in nodes)  # each node has 1 incoming edge
-    m.addConstrs(vars.sum('*',c) == 1 for c in nodes)  # each node has 1 outgoing edge
+    # PART 2: set the edge lengths as the objective, discarding the previous problem's solution
+    m.reset()
+    m.setAttr('Obj', list(vars.values()), [dist[e] for e in vars.keys()])
 
 
     # PART 3: optimise the model
-    m._vars = vars
-    m.Params.lazyConstraints = 1
+    t1 = time.time()
     m.optimize(subtourelim)  # optimise while adding lazy subtour-eliminating constraints
+    record_times('TSP', t0, t1, time.time())
 
 
     # PART 4: reconstruct tour from m.vars
     vals = m.getAttr('x', vars)
     selected = gp.tuplelist((i, j) for i, j in vals.keys() if vals[i, j] > 0.5)  # get the edges selected as tour
-    tour = subtour(selected)  # get tour from selected edges
+    tour = subtour(selected)  # get tour from selected edges (the model is kept for the next problem of this size)
 
     assert len(tour) == len(nodes)  # sanity check that the tour is actually complete
 
@@ -96,24 +183,235 @@ def subtour(edges):
     return cycle
 
 
+#-----------------CHAIN COVER (CAPACITATED PROBLEM SOLUTION)-------------------
+# The list of chains covering the wells, which also records how good it is known to be:
+# status is 'OPTIMAL' if the number of chains is proven to be the least possible, 'FEASIBLE' if not
+# (or 'UNKNOWN' if a solver found no chains at all in time); bound is the lower bound on the number of chains
+class ChainCover(list):
+    # initialisation
+    def __init__(self, chains, status, bound):
+        list.__init__(self, chains)
+        self.status = status
+        self.bound = int(bound)
+
+    # check if the cover is proven to be optimal
+    def optimal(self):
+        return (self.status == 'OPTIMAL')
+
+
 #-----------------LP PROBLEM SOLVER INTERFACE (CAPACITATED PROBLEM)-------------------
 # call the relevant LP solver based on the input
-def lp_cap(D, cap, maxtime, solver):
+# The solution only depends on which edges between the wells are zero-length, so problems with the same zero edges
+# (up to renumbering the wells) have the same solutions, which are cached; trivial problems are solved analytically
+# The chains are returned as a ChainCover, which also gives their status and lower bound
+def lp_cap(D, cap, maxtime, solver=None):
+    # PART 1: get the zero-length edges between the wells (node 0 is the 'depot')
+    D = np.asarray(D)
+    n = len(D) - 1
+    zero = (D[1:, 1:] == 0)
+    np.fill_diagonal(zero, False)
+
+    # PART 2: deal with trivial problems analytically
+    # PART 2.1: no edges can be used => one chain per well
+    if (cap < 2 or not zero.any()):
+        cache_stats['trivial'] += 1
+        return ChainCover([[i] for i in range(1, n + 1)], 'OPTIMAL', n)
+    # PART 2.2: all edges can be used => fill the chains up to capacity one by one
+    if (zero.sum() == n * (n - 1)):
+        cache_stats['trivial'] += 1
+        return ChainCover([list(range(i, min(i + int(cap), n + 1))) for i in range(1, n + 1, int(cap))], 'OPTIMAL',
+                          -(-n // int(cap)))
+
+    # PART 3: if edges to or from the depot aren't all zero-length, the problem is not standard - just solve it
+    if (D[0, 1:].any() or D[1:, 0].any()):
+        cache_stats['bypass'] += 1
+        return lp_cap_solve(D, cap, maxtime, solver)
+
+    # PART 3.1: no chain can join wells from different groups connected by zero edges (regardless of the edges' direction,
+    # so these are weakly connected components), so each group is solved separately
+    components = zero_components(zero)
+    if (len(components) > 1):
+        cache_stats['split'] += 1
+        chains = []
+        status = 'OPTIMAL' # the cover is optimal if the covers of all groups are
+        bound = 0 # lower bounds of the groups add up
+        # each group is given a share of the time left proportional to its weight, so time unused by groups solved early
+        # is passed on to the rest; if the share is too short to run the solver, the group is solved by bipartite matching
+        endtime = time.time() + maxtime
+        compnodes = [np.concatenate(([0], comp + 1)) for comp in components] # nodes of each group's subgraph
+        weights = [subD_weight(D[np.ix_(nodes, nodes)]) if (len(nodes) > 3) else 0 for nodes in compnodes]
+        weightleft = sum(weights)
+        for c in range(0, len(components)):
+            comp = components[c]
+            # a single well is a chain on its own
+            if (len(comp) == 1):
+                chains.append([comp[0] + 1])
+                bound += 1
+            # two connected wells form one chain
+            elif (len(comp) == 2):
+                if (zero[comp[0], comp[1]]):
+                    chains.append([comp[0] + 1, comp[1] + 1])
+                else:
+                    chains.append([comp[1] + 1, comp[0] + 1])
+                bound += 1
+            # bigger groups are solved as problems of their own
+            else:
+                nodes = compnodes[c]
+                share = max(endtime - time.time(), 0) * weights[c] / max(weightleft, 1)
+                weightleft -= weights[c]
+                compchains = lp_cap(D[np.ix_(nodes, nodes)], cap, share, budget_solver(weights[c], share, solver))
+                for chain in compchains:
+                    chains.append([int(nodes[k]) for k in chain])
+                if (not compchains.optimal()):
+                    status = 'FEASIBLE'
+                bound += compchains.bound
+        return ChainCover(chains, status, bound)
+
+    # PART 4: look the problem up in the cache
+    order = canonical_order(zero)
+    key = (n, cap, solver, np.packbits(zero[np.ix_(order, order)]).tobytes())
+    if (key in cache):
+        cache_stats['hits'] += 1
+        cache.move_to_end(key)
+        chains, status, bound = cache[key]
+        return ChainCover([[int(order[c - 1]) + 1 for c in chain] for chain in chains], status, bound) # renumber wells
+
+    # PART 5: solve the problem and cache the solution (with the wells numbered canonically)
+    # The time limit is not in the key, so only solutions that don't depend on it are cached: those proven optimal,
+    # and those found by bipartite matching (otherwise, a solution found in a short time would be reused for longer ones)
+    cache_stats['misses'] += 1
+    chains = lp_cap_solve(D, cap, maxtime, solver)
+    if (chains.optimal() or solver == 'matching'):
+        position = np.argsort(order) # canonical position of each well
+        cache[key] = ([[int(position[c - 1]) + 1 for c in chain] for chain in chains], chains.status, chains.bound)
+        if (len(cache) > cache_size):
+            cache.popitem(last=False) # evict the least recently used solution
+    return chains
+
+
+# call the relevant LP solver based on the input, without caching
+# (problems with up to exact_max wells are solved exactly by bitmask DP instead, which is faster than starting a solver)
+def lp_cap_solve(D, cap, maxtime, solver):
+    starttime = time.time()
+    if(len(D) - 1 <= exact_max):
+        chains = dp_lp_cap(D,cap)
+        return ChainCover(chains, 'OPTIMAL', len(chains))
+
+    # get a solution by bipartite matching first - if it meets the lower bound, it is optimal and no solver is needed
+    heur = match_lp_cap(D,cap)
+    lb = lp_cap_bound(D,cap)
+    if(len(heur) <= lb):
+        cache_stats['bound'] += 1
+        return ChainCover(heur, 'OPTIMAL', lb)
+    if(solver=='matching'):
+        return ChainCover(heur, 'FEASIBLE', lb) #bipartite matching heuristic, needs no LP solver
+
+    # otherwise, call the solver, telling it the lower bound so that it stops once a solution meets it
+    # (it only gets the time left after the matching)
+    maxtime = max(maxtime - (time.time() - starttime), 0)
     if(solver=='GUROBI'):
-        return gur_lp_cap(D,cap,maxtime) #use GUROBI if specified
+        chains = gur_lp_cap(D,cap,maxtime,lb) #use GUROBI if specified
+    elif(solver=='CP-SAT'):
+        chains = cpsat_lp_cap(D,cap,maxtime,lb) #native CP-SAT model with routing constraints
     else:
-        return or_lp_cap(D,cap,maxtime) #use OR-tools by default
+        chains = or_lp_cap(D,cap,maxtime,lb) #use OR-tools by default
+
+    # if the solver found no solution in time, or a worse one, fall back to bipartite matching
+    if (sum(len(chain) for chain in chains) != len(D) - 1 or len(chains) > len(heur)):
+        return ChainCover(heur, 'FEASIBLE', max(lb, chains.bound))
+    # the solver's own bound may be weaker than lb (and its solution may meet lb without the solver proving it)
+    chains.bound = max(lb, chains.bound)
+    if (len(chains) <= chains.bound):
+        chains.status = 'OPTIMAL'
+    return chains
+
+
+# get a lower bound on the number of chains covering the wells, the best of two:
+# a) the number of wells left unmatched by maximum bipartite matching over the zero edges (each chain's links are
+# distinct zero edges forming a matching, so a cover with k chains has n - k links and k >= n - |maximum matching|)
+# b) the number of chains needed if all of them were filled up to capacity
+def lp_cap_bound(D, cap):
+    n = len(D) - 1
+    zero = (np.asarray(D)[1:, 1:] == 0)
+    np.fill_diagonal(zero, False)
+    matched = sum(1 for j in hopcroft_karp([np.flatnonzero(zero[i]).tolist() for i in range(0, n)], n) if j != -1)
+    return max(n - matched, -(-n // int(cap)))
+
+
+# cached solutions of lp_cap, keyed by the problem's size, capacity, solver and zero edges (in canonical well order)
+cache = OrderedDict()
+cache_size = 1024 # maximum number of cached solutions
+cache_stats = {'hits': 0, 'misses': 0, 'trivial': 0, 'bypass': 0, 'split': 0, 'bound': 0}
+exact_max = 14 # maximum number of wells for which the problem is solved exactly by dp_lp_cap
+min_solve_time = 0.05 # shortest time limit (in seconds) worth running an LP solver for
+# least time (in seconds) a solver takes per zero edge, whatever its time limit: building the model and presolving it
+# can't be cut short (measured for OR-tools, which takes 4-6e-5 s per zero edge)
+solver_overhead_per_edge = 6e-5
+
+
+# choose the solver for a problem of a given weight given share seconds: if the share is too short to run the solver,
+# including building and presolving its model (which take longer the more zero edges there are), bipartite matching is
+# used instead (problems of zero weight are solved exactly by bitmask DP in no time anyway)
+def budget_solver(weight, share, solver):
+    if (weight != 0 and share < min_solve_time + weight * solver_overhead_per_edge):
+        return 'matching'
+    return solver
+
+
+# estimate how hard the LP problem with distance matrix subD is, by the number of zero edges between the wells
+# (problems small enough to be solved exactly by bitmask DP take almost no time)
+def subD_weight(subD):
+    if (len(subD) - 1 <= exact_max):
+        return 0
+    return int(np.count_nonzero(subD[1:, 1:] == 0))
+
+
+# empty the cache of lp_cap solutions and reset the statistics
+def lp_cache_clear():
+    cache.clear()
+    for stat in cache_stats:
+        cache_stats[stat] = 0
+
+
+# get the groups of wells connected by zero edges (in either direction), as arrays of well indices
+def zero_components(zero):
+    linked = zero | zero.T
+    unvisited = np.ones(len(zero), dtype=bool)
+    components = []
+    while (unvisited.any()):
+        # start from the first well not yet in any group, and add the neighbours of the group's wells until none are left
+        comp = np.zeros(len(zero), dtype=bool)
+        frontier = np.zeros(len(zero), dtype=bool)
+        frontier[np.argmax(unvisited)] = True
+        while (frontier.any()):
+            comp |= frontier
+            unvisited &= ~frontier
+            frontier = linked[frontier].any(axis=0) & unvisited
+        components.append(np.flatnonzero(comp))
+    return components
+
+
+# get a canonical order of wells given the matrix of zero edges between them, so that renumbered wells get the same order
+# (wells are sorted by their numbers of zero edges, refined by those of their neighbours; remaining ties are broken by
+# the current numbering, so some renumberings of the same problem may still get different keys)
+def canonical_order(zero):
+    n = len(zero)
+    colour = zero.sum(axis=1) * (n + 1) + zero.sum(axis=0)
+    for r in range(0, 2):
+        signatures = [(colour[i], tuple(np.sort(colour[zero[i]])), tuple(np.sort(colour[zero[:, i]]))) for i in range(0, n)]
+        ranks = {sig: rank for rank, sig in enumerate(sorted(set(signatures)))}
+        colour = np.array([ranks[sig] for sig in signatures])
+    return np.lexsort((np.arange(n), colour))
 
 
 #-----------------GUROBI: LP PROBLEM SOLVER (CAPACITATED PROBLEM)-------------------
 #solver
-def gur_lp_cap(D, cap, maxtime):
+# if lb is given, the number of chains is constrained to be at least lb, so the solver stops once a solution meets it
+# (returns a ChainCover)
+def gur_lp_cap(D, cap, maxtime, lb=None):
     # PART 0: technical GUROBI works
-
-    # PART 0.1: set output flag to 0 to stop gurobi from printing out the log
-    env = gp.Env(empty=True)
-    env.setParam('OutputFlag', 0)
-    env.start()
+    t0 = time.time()
+    env = get_gurobi_env()
 
     # PART 1: initial preparations
     # PART 1.1: get the auxiliary array of node indices
@@ -121,16 +419,17 @@ def gur_lp_cap(D, cap, maxtime):
     for i in range(0, len(D)):
         nodes.append(i)
     wellnodes = nodes[1:len(nodes)] # record only nodes matched to wells (i.e. except 0)
-    
-    # PART 1.2: convert distance matrix into the dictionary format used by GUROBI
-    dist = {(i, j): D[i][j] for i, j in product(nodes, nodes) if i != j}
+
+    # PART 1.2: get the edges that can be selected into chains, i.e. zero-length ones
+    # (no other edges are included in the model, so its size scales with the number of zero-length edges)
+    arcs = zero_arcs(D)
 
     # PART 1.3: create the GUROBI model
     m = gp.Model(env=env)
 
     # PART 1.4: create a boolean matrix indicating the trip (commonly known as X in literature)
     # Note: the objective will be to minimise number of chosen edges leaving the 'depot', i.e. sum X_0,c for all c
-    vars = m.addVars(dist.keys(), vtype=GRB.BINARY, name='e')
+    vars = m.addVars(arcs, vtype=GRB.BINARY, name='e')
 
     # PART 1.5: copy capacity into a global variable to let other functions use it
     global gurcap
@@ -147,28 +446,44 @@ def gur_lp_cap(D, cap, maxtime):
     # create dummy variables needed for constraints
     u = {}
     for i in wellnodes:
-        u[i] = m.addVar(lb=0, ub=gurcap, vtype="C", name="u(%s)" % i)
+        u[i] = m.addVar(lb=0, ub=gurcap - 1, vtype="C", name="u(%s)" % i)
 
-    # add the constraints
+    # add the constraints (only for the edges between wells present in the model)
     if (gurcap > 1.5):
-        m.addConstrs(u[j] - u[i] >= 1 - gurcap * (1 - vars[i, j]) for i, j in combinations(wellnodes, 2))
-        m.addConstrs(u[i] - u[j] >= 1 - gurcap * (1 - vars[j, i]) for i, j in combinations(wellnodes, 2))
+        m.addConstrs(u[j] - u[i] >= 1 - gurcap * (1 - vars[i, j]) for i, j in arcs if (i != 0 and j != 0))
 
-    # PART 2.3: all edges selected into chains must be zero-length
-    m.addConstr(
-        gp.quicksum(vars[i, j] * dist[(i, j)] + vars[j, i] * dist[(j, i)] for i, j in combinations(nodes, 2)) == 0)
+    # PART 2.3: state the lower bound on the number of chains, if known
+    if (lb != None):
+        m.addConstr(gp.quicksum(vars[i, j] for i, j in arcs if i == 0) >= lb)
 
     # PART 3: optimise the model
-    m.Params.TIME_LIMIT = maxtime # set optimisation time limit
-    m.setObjective(gp.quicksum(vars[0, c] for c in wellnodes), GRB.MINIMIZE) #set objective
+    m.Params.TIME_LIMIT = max(maxtime - (time.time() - t0), 0.001) # set optimisation time limit (what is left after the setup)
+    m.setObjective(gp.quicksum(vars[i, j] for i, j in arcs if i == 0), GRB.MINIMIZE) #set objective
+    t1 = time.time()
     m.optimize() #optimise
+    record_times('GUROBI', t0, t1, time.time())
+    if (lb == None):
+        lb = 0
+    if (m.SolCount == 0): # no solution found in time
+        m.dispose()
+        return ChainCover([], 'UNKNOWN', lb)
+    bound = max(lb, np.ceil(m.ObjBound - 1e-6))
+    status = 'OPTIMAL' if (m.Status == GRB.OPTIMAL) else 'FEASIBLE'
 
 
     # PART 4: reconstruct the chains from m.vars (matrix X in literature)
     vals = m.getAttr('x', vars)
     selected = gp.tuplelist((i, j) for i, j in vals.keys() if vals[i, j] > 0.5)  # get the edges selected as tour
+    m.dispose() # free the model (the environment is kept)
+
+    return ChainCover(gur_recover(selected), status, bound)  # get tour from selected edges
 
-    return gur_recover(selected)  # get tour from selected edges
+
+# get the list of zero-length edges (i,j) in the graph with distance matrix D, excluding loops
+def zero_arcs(D):
+    zero = (np.asarray(D) == 0)
+    np.fill_diagonal(zero, False)
+    return [(int(i), int(j)) for i, j in zip(*np.nonzero(zero))]
 
 
 # recover the chains
@@ -193,10 +508,288 @@ def gur_recover(edges):
     return chains
 
 
+#-----------------BITMASK DP: EXACT SOLVER FOR SMALL PROBLEMS (CAPACITATED PROBLEM)-------------------
+# The state is the set of wells already covered (as a bitmask) and the last well covered. For each state, the best
+# partial cover is recorded as chains*(cap+1)+length of the last chain: fewer chains are always better, and for the
+# same number of chains, a shorter last chain leaves more room for the next wells
+def dp_lp_cap(D, cap):
+    # PART 1: initial preparations
+    n = len(D) - 1
+    cap = int(cap)
+    zero = (np.asarray(D)[1:, 1:] == 0)
+    np.fill_diagonal(zero, False)
+    full = (1 << n) - 1
+    worst = np.iinfo(np.int32).max
+
+    # PART 1.1: best values and the previous well leading to them, for each state
+    best = np.full((full + 1, n), worst, dtype=np.int32)
+    prev = np.full((full + 1, n), -1, dtype=np.int8)
+
+    # PART 1.2: group the bitmasks by the number of wells covered
+    masks = np.arange(full + 1)
+    popcount = np.zeros(full + 1, dtype=int)
+    for v in range(0, n):
+        popcount += (masks >> v) & 1
+
+    # PART 2: fill in the values
+    # PART 2.1: a single well covered - one chain of length 1
+    for v in range(0, n):
+        best[1 << v, v] = 1 * (cap + 1) + 1
+
+    # PART 2.2: add wells one by one
+    for k in range(1, n):
+        layer = masks[popcount == k]
+        vals = best[layer] # values of all states in the layer, as (mask, last well)
+        chains = vals // (cap + 1)
+        lens = vals % (cap + 1)
+        newchain = (chains + 1) * (cap + 1) + 1 # value if the next well starts a new chain
+        for v in range(0, n):
+            # only extend the states not covering well v yet
+            free = ((layer >> v) & 1) == 0
+            # the next well can continue the chain if there is a zero edge to it and the chain is not full
+            cand = np.where(zero[:, v] & (lens[free] < cap), vals[free] + 1, newchain[free])
+            cand[vals[free] == worst] = worst
+            # find the best previous well
+            last = np.argmin(cand, axis=1)
+            best[layer[free] | (1 << v), v] = cand[np.arange(len(last)), last]
+            prev[layer[free] | (1 << v), v] = last
+
+    # PART 3: reconstruct the chains, going back from the best last well
+    chains = []
+    chain = []
+    mask = full
+    v = int(np.argmin(best[full]))
+    while (v != -1):
+        chain.insert(0, v + 1)
+        # the well is the first in its chain if the chain length is 1
+        if (best[mask, v] % (cap + 1) == 1):
+            chains.insert(0, chain)
+            chain = []
+        lastv = int(prev[mask, v])
+        mask &= ~(1 << v)
+        v = lastv
+
+    return chains
+
+
+#-----------------MATCHING: CHAIN COVER HEURISTIC (CAPACITATED PROBLEM)-------------------
+# Heuristic: each edge of a maximum bipartite matching links a well to the next one in a chain, so that the chains cover
+# the wells with n - |matching| chains if the matched edges form no cycles. The zero-edge graphs do have cycles (e.g. two
+# wells of the same earlier subsets have zero edges both ways), which are broken, so more chains may be needed - the
+# number of chains is at least n - |matching|. Then the chains are split to fit the capacity, and, if repair is True,
+# short chains are joined where possible
+def match_lp_cap(D, cap, repair=True):
+    # PART 1: initial preparations
+    n = len(D) - 1
+    zero = (np.asarray(D)[1:, 1:] == 0)
+    np.fill_diagonal(zero, False)
+    adj = [np.flatnonzero(zero[i]).tolist() for i in range(0, n)] # zero edges going out of each well
+
+    # PART 2: find the maximum matching
+    succ = hopcroft_karp(adj, n) # succ[i] is the well following i in a chain (-1 if none)
+
+    # PART 3: turn the matching into chains
+    # PART 3.1: chains start at wells with no preceding well
+    haspred = np.zeros(n, dtype=bool)
+    for i in range(0, n):
+        if (succ[i] != -1):
+            haspred[succ[i]] = True
+    visited = np.zeros(n, dtype=bool)
+    longchains = []
+    for start in list(np.flatnonzero(~haspred)) + list(range(0, n)):
+        # PART 3.2: wells left unvisited after going through all chains form cycles, which are broken before the first well
+        if (visited[start]):
+            continue
+        chain = []
+        cur = start
+        while (cur != -1 and not visited[cur]):
+            chain.append(cur)
+            visited[cur] = True
+            cur = succ[cur]
+        longchains.append(chain)
+
+    # PART 3.3: split the chains into parts no longer than the capacity
+    chains = []
+    for chain in longchains:
+        for i in range(0, len(chain), int(cap)):
+            chains.append(chain[i:i + int(cap)])
+
+    # PART 4: join the chains that can be joined without exceeding the capacity
+    if (repair):
+        joined = True
+        while (joined):
+            joined = False
+            for a in range(0, len(chains)):
+                for b in range(0, len(chains)):
+                    if (a != b and len(chains[a]) + len(chains[b]) <= cap and zero[chains[a][-1], chains[b][0]]):
+                        chains[a] = chains[a] + chains[b]
+                        chains.pop(b)
+                        joined = True
+                        break
+                if (joined):
+                    break
+
+    # PART 5: return the chains, with the wells numbered from 1 as in D
+    chains.sort()
+    return [[int(c) + 1 for c in chain] for chain in chains]
+
+
+# Hopcroft-Karp maximum bipartite matching between wells as predecessors and wells as successors;
+# adj[i] lists the possible successors of well i. Returns the matched successor of each well (-1 if none)
+def hopcroft_karp(adj, n):
+    matchsucc = [-1] * n # successor matched to each well
+    matchpred = [-1] * n # predecessor matched to each well
+    inf = n + 1
+
+    while True:
+        # PART 1: breadth-first search from unmatched predecessors, layering the graph by alternating path lengths
+        dist = [inf] * n
+        queue = []
+        for u in range(0, n):
+            if (matchsucc[u] == -1):
+                dist[u] = 0
+                queue.append(u)
+        found = False
+        for u in queue:
+            for v in adj[u]:
+                w = matchpred[v]
+                if (w == -1):
+                    found = True
+                elif (dist[w] == inf):
+                    dist[w] = dist[u] + 1
+                    queue.append(w)
+        # stop if there are no augmenting paths left
+        if (not found):
+            return matchsucc
+
+        # PART 2: depth-first search along the layers for vertex-disjoint augmenting paths (iterative to avoid deep recursion)
+        nextedge = [0] * n
+        for root in range(0, n):
+            if (matchsucc[root] != -1):
+                continue
+            stack = [root] # predecessors on the current path
+            vs = [] # successors on the current path
+            while (len(stack) != 0):
+                u = stack[-1]
+                if (nextedge[u] < len(adj[u])):
+                    v = adj[u][nextedge[u]]
+                    nextedge[u] += 1
+                    w = matchpred[v]
+                    if (w == -1):
+                        # augmenting path found: flip the matching along it
+                        vs.append(v)
+                        for k in range(0, len(stack)):
+                            matchsucc[stack[k]] = vs[k]
+                            matchpred[vs[k]] = stack[k]
+                        break
+                    elif (dist[w] == dist[u] + 1):
+                        vs.append(v)
+                        stack.append(w)
+                else:
+                    # dead end: exclude this predecessor from the search
+                    dist[u] = inf
+                    stack.pop()
+                    if (len(vs) != 0):
+                        vs.pop()
+
+
+#-----------------OR TOOLS/CP-SAT: ROUTING MODEL (CAPACITATED PROBLEM)-------------------
+# Chains are modelled as circuits through the 'depot' node 0, with only the zero-length edges between wells available.
+# The chains are returned as a ChainCover, giving the solver's status and the lower bound on the number of chains
+# (lb is the lower bound on the number of chains; found by lp_cap_bound if not given)
+def cpsat_lp_cap(D, cap, maxtime, lb=None):
+    # PART 1: initial preparations
+    t0 = time.time()
+    n = len(D) - 1
+    zero = (np.asarray(D)[1:, 1:] == 0)
+    np.fill_diagonal(zero, False)
+    model = cp_model.CpModel()
+
+    # PART 1.1: create the arcs - leaving and returning to the depot for every well, and zero edges between wells
+    starts = {}
+    ends = {}
+    edges = {}
+    arcs = []
+    for i in range(1, n + 1):
+        starts[i] = model.NewBoolVar('x(0,' + str(i) + ')')
+        ends[i] = model.NewBoolVar('x(' + str(i) + ',0)')
+        arcs.append((0, i, starts[i]))
+        arcs.append((i, 0, ends[i]))
+    for i, j in zip(*np.nonzero(zero)):
+        edges[(i + 1, j + 1)] = model.NewBoolVar('x(' + str(i + 1) + ',' + str(j + 1) + ')')
+        arcs.append((i + 1, j + 1, edges[(i + 1, j + 1)]))
+
+    # PART 1.2: create the load variables - position of each well in its chain
+    u = {}
+    for i in range(1, n + 1):
+        u[i] = model.NewIntVar(1, int(cap), 'u' + str(i))
+
+
+    # PART 2: add constraints
+
+    # PART 2.1: every well is visited exactly once by a circuit through the depot
+    model.AddMultipleCircuit(arcs)
+
+    # PART 2.2: chains start with load 1, and each following well has load higher by 1 (which limits the chains' length)
+    for i in range(1, n + 1):
+        model.Add(u[i] == 1).OnlyEnforceIf(starts[i])
+    for (i, j) in edges:
+        model.Add(u[j] == u[i] + 1).OnlyEnforceIf(edges[(i, j)])
+
+    # PART 2.3: the number of chains is at least the number of wells left unmatched by maximum matching (which ignores
+    # capacity), and at least the number of chains needed to fill them up to capacity - stating it helps prove optimality
+    if (lb == None):
+        lb = lp_cap_bound(D, cap)
+    model.Add(sum(starts.values()) >= lb)
+
+    # PART 3: optimise the model
+    # PART 3.1: define the objective - number of chains
+    model.Minimize(sum(starts.values()))
+
+    # PART 3.2: hint at a good solution found by bipartite matching
+    hint = match_lp_cap(D, cap)
+    for i in range(1, n + 1):
+        model.AddHint(starts[i], any(chain[0] == i for chain in hint))
+        model.AddHint(ends[i], any(chain[-1] == i for chain in hint))
+    hinted = set()
+    for chain in hint:
+        for k in range(0, len(chain)):
+            model.AddHint(u[chain[k]], k + 1)
+            if (k != 0):
+                hinted.add((chain[k - 1], chain[k]))
+    for ij in edges:
+        model.AddHint(edges[ij], ij in hinted)
+
+    # PART 3.3: run the solver
+    solver = get_cpsat_solver()
+    solver.parameters.max_time_in_seconds = max(maxtime - (time.time() - t0), 0.001) # what is left after the setup
+    solver.parameters.num_search_workers = 1 # restrict searching to 1 CPU core for safety and performance consistency
+    t1 = time.time()
+    status = solver.Solve(model)
+    record_times('CP-SAT', t0, t1, time.time())
+
+    # PART 4: reconstruct the chains (if no solution has been found, use the hint)
+    if (status != cp_model.OPTIMAL and status != cp_model.FEASIBLE):
+        return ChainCover(hint, 'FEASIBLE', lb)
+    bound = max(lb, np.ceil(solver.BestObjectiveBound() - 1e-6))
+    succ = {i: j for (i, j) in edges if solver.BooleanValue(edges[(i, j)])}
+    chains = []
+    for i in range(1, n + 1):
+        if (solver.BooleanValue(starts[i])):
+            chain = [i]
+            while (chain[-1] in succ):
+                chain.append(succ[chain[-1]])
+            chains.append(chain)
+    return ChainCover(chains, solver.StatusName(status), bound)
+
+
 #-----------------OR TOOLS/GLOP: LP PROBLEM SOLVER (CAPACITATED PROBLEM)-------------------
-def or_lp_cap(D,cap,maxtime):
+# (returns a ChainCover)
+# if lb is given, the number of chains is constrained to be at least lb, so the solver stops once a solution meets it
+def or_lp_cap(D,cap,maxtime,lb=None):
     # PART 0: technical OR TOOLS works
-    solver = pywraplp.Solver('CP-SAT_Solve',pywraplp.Solver.SAT_INTEGER_PROGRAMMING)
+    t0 = time.time()
+    solver = get_ortools_solver()
 
     # PART 1: initial preparations
     # PART 1.1: copy capacity into a global variable to let other functions use it
@@ -209,15 +802,19 @@ def or_lp_cap(D,cap,maxtime):
         nodes.append(i)
     wellnodes = nodes[1:len(nodes)]  # record only nodes matched to wells (i.e. except 0)
 
-    # PART 1.3: convert distance matrix into the dictionary format used by GUROBI
-    dist = {(i, j): D[i][j] for i, j in product(nodes, nodes) if i != j}
+    # PART 1.3: get the edges that can be selected into chains, i.e. zero-length ones
+    # (no other edges are included in the model, so its size scales with the number of zero-length edges)
+    arcs = zero_arcs(D)
 
     # PART 1.4: create a boolean matrix indicating the trip (commonly known as X in literature)
     # Note: the objective will be to minimise number of chosen edges leaving the 'depot', i.e. sum X_0,c for all c
     vars = {}
-    for i,j in combinations(nodes, 2):
+    arcsin = {k: [] for k in nodes} # edges coming into each node
+    arcsout = {k: [] for k in nodes} # edges going out of each node
+    for i,j in arcs:
         vars[(i, j)]=solver.IntVar(0, 1, 'x('+str(i)+','+str(j)+')')
-        vars[(j, i)] = solver.IntVar(0, 1, 'x(' + str(j) + ',' + str(i) + ')')
+        arcsout[i].append(vars[(i, j)])
+        arcsin[j].append(vars[(i, j)])
     # create dummy variables needed for constraints
     u = {}
     for i in wellnodes:
@@ -231,34 +828,39 @@ def or_lp_cap(D,cap,maxtime):
     constrs['out'] = {}
 
     for k in wellnodes:
-        # make list of well indices APART from that of the current well
-        if (k != nodes[-1]):
-            nodes_no_k=nodes[:k]+nodes[(k+1):]
-        else:
-            nodes_no_k = nodes[:k]
-        constrs['in'][k]=solver.Add(solver.Sum(vars[(i, k)] for i in nodes_no_k)==1) # each well node has at most 1 incoming edge
-        constrs['out'][k] = solver.Add(solver.Sum(vars[(k, j)] for j in nodes_no_k) == 1) # each well node has at most 1 outgoing edge
+        constrs['in'][k]=solver.Add(solver.Sum(arcsin[k])==1) # each well node has at most 1 incoming edge
+        constrs['out'][k] = solver.Add(solver.Sum(arcsout[k]) == 1) # each well node has at most 1 outgoing edge
 
     # PART 2.2: eliminate cycles and chains that are too long
-    # add the constraints on dummy variables
+    # add the constraints on dummy variables (only for the edges between wells present in the model)
     if (orcap > 1.5):
         constrs['u'] = {}
-        for k,l in product(wellnodes,wellnodes):
-            if(k != l):
+        for k,l in arcs:
+            if(k != 0 and l != 0):
                 constrs['u'][(k,l)]=solver.Add(u[l]-u[k]-orcap*vars[(k,l)] >= 1-orcap)
 
-    # PART 2.3: all edges selected into chains must be zero-length
-    constrs['cost'] = {'sum': solver.Add(solver.Sum(vars[(i, j)] * dist[(i, j)] + vars[j, i] * dist[(j, i)]
-                                                    for i, j in combinations(nodes, 2)) == 0)}
+    # PART 2.3: state the lower bound on the number of chains, if known
+    if (lb != None):
+        constrs['lb'] = solver.Add(solver.Sum(arcsout[0]) >= lb)
 
     # PART 3: optimise the model
     # PART 3.1: define the objective
-    obj=solver.Minimize(solver.Sum(vars[(0,j)] for j in wellnodes))
+    obj=solver.Minimize(solver.Sum(arcsout[0]))
 
     # PART 3.2: run the solver
-    solver.set_time_limit(maxtime*1000) # mind that OR tools define it in MILLISECONDS!
+    # what is left of the time after the setup is given to the solver - mind that OR tools define it in MILLISECONDS!
+    # (and 0 means no limit)
+    solver.set_time_limit(max(int((maxtime - (time.time() - t0)) * 1000), 1))
     solver.num_search_workers=1 # restrict searching to 1 CPU core for safety and performance consistency
+    t1 = time.time()
     status=solver.Solve()
+    record_times('ORtools', t0, t1, time.time())
+    if (lb == None):
+        lb = 0
+    if (status != pywraplp.Solver.OPTIMAL and status != pywraplp.Solver.FEASIBLE): # no solution found in time
+        return ChainCover([], 'UNKNOWN', lb)
+    bound = max(lb, np.ceil(solver.Objective().BestBound() - 1e-6))
+    status = 'OPTIMAL' if (status == pywraplp.Solver.OPTIMAL) else 'FEASIBLE'
 
     # PART 4: reconstruct the chains from m.vars (matrix X in literature)
     selected=[]
@@ -266,7 +868,7 @@ def or_lp_cap(D,cap,maxtime):
         if(vars[ij].solution_value()==1):
             selected.append(ij)
 
-    return or_recover(selected)  # get tour from selected edges
+    return ChainCover(or_recover(selected), status, bound)  # get tour from selected edges
 
 
 def or_recover(edges):
@@ -148,7 +148,7 @@ def moclo_part_transfer_actions_onelen(method, constructs, part_vol, pipette_vol
     caps = capacities(reqvols=reqvols, pipcap=pipette_volume, airgap=air_gap)
 
     # PART 2 Solve the problem
-    fin = []  # output operations (internal format)
+    fin = Plan()  # output operations (internal format, compact)
 
     # PART 2.1 call algorithm specified by method
     if (method[0:2] == 'LP'):  # LP-based
@@ -175,13 +175,23 @@ def moclo_part_transfer_actions_onelen(method, constructs, part_vol, pipette_vol
         elif (method[:6] == 'Greedy'):
             greedy_tree(w, fin, 'optimistic+cap', reord, caps)
 
-    # PART 2.2 Print report on solution benefits
+    # PART 2.2 Check the plan before it is reported (tip changes already in fin are kept)
+    for i, (op, cost) in enumerate(verify_iter(fin, w, caps, keepchanges=True)):
+        # if the tip cannot be kept without contamination or exceeding capacity, change it anyway
+        if (cost == 1 and not op.changed):
+            if (i != 0):
+                print('pipette_opt: WARNING - the plan keeps the tip before operation '+str(i)+' where it must be changed')
+            op.changed = True
+
+    # PART 2.3 Print report on solution benefits
     cost = route_cost(fin)
     savings = len(fin) - cost
     percentsavings = savings / len(fin) * 100
     print('pipette_opt:\n')
     print(str(savings) + ' pipette tips saved (' + str(percentsavings) + '%)')
-    print('Thus ' + str(cost) + ' tips required\n')
+    print('Thus ' + str(cost) + ' tips required')
+    lb = lower_bound(w, caps)
+    print('At least ' + str(lb) + ' tips are needed for this input (optimality gap at most ' + str(optimality_gap(cost, lb)) + '%)\n')
 
     # PART 3 Convert internal-output operations into an action list
 
@@ -189,28 +199,17 @@ def moclo_part_transfer_actions_onelen(method, constructs, part_vol, pipette_vol
     action_list = tuple()
     new_tip = 'once'
 
-    # PART 3.2 Define auxiliary variables
-    added = np.zeros((len(w), len(w[0])))  # tells which parts were added to which well
-
-    # PART 3.3 The first operation in fin
-    added[fin[0].well][fin[0].part[0]] = 1
-    fin[0].changed = True
+    # PART 3.2 The first operation in fin
     part_source = dic['parts'][fin[0].part]['part_name']
     part_vol = reqvols[fin[0].part]
     part_dest = [dic['constructs'][fin[0].well]['con_name']].copy()
 
-    # PART 3.4 All later operations
+    # PART 3.3 All later operations
     for i in range(1, len(fin)):
-        # get operation cost
-        cost = cost_func_with_w(fin[0:i], fin[i], w, added, caps)
-        if (cost == 1):
-            fin[i].changed = True
-        added[fin[i].well][fin[i].part[0]] = 1
-
-        # act accroding to cost
-        if (cost == 0):  # if 0, tip is unchanged
+        # act accroding to whether the tip was changed
+        if not (fin[i].changed):  # if the tip is unchanged
             part_dest += [dic['constructs'][fin[i].well]['con_name']]
-        else:  # if 1, there is new tip, so...
+        else:  # if there is a new tip...
             # record last tip's actions
             action_list += ((part_source, part_dest, part_vol, new_tip, air_gap),)
 
@@ -25,6 +25,7 @@ Make the following changes to assembly.py:
         ...'LP+sametogether'
         ...'LP+leastout'
         ...'LP+greedy'
+        ...'LP+greedy surrogate' (faster: estimates the parts' tip counts instead of solving LP problems to reorder them)
         ...'LP+nearest neighbour'
         ...'LP+iddfs depth 2'
         ...'Nearest Neighbour'
@@ -136,7 +137,7 @@ def startstop_actionlist(assembly,method, pipette):
     caps = capacities(reqvols=reqvols, pipcap=pipette.max_volume, airgap=air_gap)
 
     # PART 2 Solve the problem
-    fin = [] # output operations (internal format)
+    fin = Plan() # output operations (internal format, compact)
 
     # PART 2.1 call algorithm specified by method
     if (method[0:2] == 'LP'): # LP-based
@@ -163,14 +164,24 @@ def startstop_actionlist(assembly,method, pipette):
         elif (method[:6] == 'Greedy'):
             greedy_tree(w, fin, 'optimistic+cap', reord, caps)
 
-    # PART 2.2 Print report on solution benefits
+    # PART 2.2 Check the plan before it is reported and recorded (tip changes already in fin are kept)
+    for i, (op, cost) in enumerate(verify_iter(fin, w, caps, keepchanges=True)):
+        # if the tip cannot be kept without contamination or exceeding capacity, change it anyway
+        if (cost == 1 and not op.changed):
+            if (i != 0):
+                print('pipette_opt: WARNING - the plan keeps the tip before operation '+str(i)+' where it must be changed')
+            op.changed = True
+
+    # PART 2.3 Print report on solution benefits
     cost = route_cost(fin)
     savings = len(fin) - cost
     percentsavings = savings/len(fin)*100
     print('\npipette_opt: '+str(savings) + ' pipette tips saved (' + str(percentsavings) + '%)')
-    print('Thus ' + str(cost) + ' tips required\n')
+    print('Thus ' + str(cost) + ' tips required')
+    lb = lower_bound(w, caps)
+    print('At least ' + str(lb) + ' tips are needed for this input (optimality gap at most ' + str(optimality_gap(cost, lb)) + '%)\n')
 
-    # PART 2.3 Record in a .p file
+    # PART 2.4 Record in a .p file
     rec('Start-Stop',w,fin,dic,caps)
 
     # PART 3 Convert internal-output operations into action list
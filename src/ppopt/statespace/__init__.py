@@ -1,5 +1,5 @@
 """statespace - state-space graph searching optimisation methods"""
-from .statespace_methods import nns,greedy_tree
+from .statespace_methods import nns,greedy_tree,beam_search
 
 __version__ = '0.1.0'
 __author__ = 'Kirill Sechkar <kirill.sechkar18@imperial.ac.uk>'
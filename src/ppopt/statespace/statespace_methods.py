@@ -3,6 +3,7 @@
 # v0.1.0, 22.7.20
 
 from ppopt.auxil import *
+import itertools
 
 
 # ---------------------------------NNs SOLVER------------------------------------
@@ -10,18 +11,32 @@ from ppopt.auxil import *
 def nns(w, fin, depth, reord,caps):
     # PART 1: intial preparations
 
+    # PART 1.0: compile the input (w can also be given as a Problem)
+    w = to_problem(w, caps)
+    caps = w.caps
+
     # PART 1.1: get an Oper list of operations to be performed
     ops = []
     w_to_ops(w, ops, reord)
     all_operations = len(ops) # get the total number of subsets
 
-    # PART 1.3: make w and capacity global for simplicity
-    global globw, globcaps
+    # PART 1.2: get the same operations as an integer array for batch cost evaluation
+    opsarr = ops_to_array(ops)
+
+    # PART 1.3: make w (also in integer matrix form) and capacity global for simplicity
+    global globw, globwmat, globcaps
     globw = w
+    globwmat = w.wmat
     globcaps = caps
 
     # PART 1.4: create the array added (tells which parts were added to which well)
-    added = np.zeros((len(w), len(w[0])), dtype=bool)  # added[i][j]==True if part at address j in well i has been added
+    added = np.zeros((w.n_wells, w.n_types), dtype=bool)  # added[i][j]==True if part at address j in well i has been added
+
+    # PART 1.5: keep track of the tip's contents to check capacity quickly
+    tip = TipState()
+
+    # PART 1.6: group unperformed operations by part (only the last operation's part can be added with the same tip)
+    buckets = PartBuckets(w.partid[opsarr[:, 2], opsarr[:, 0]], w.n_parts)
 
 
     # PART 2: get the sequence of operations
@@ -30,56 +45,80 @@ def nns(w, fin, depth, reord,caps):
     fin.append(ops[0]) # record operation
     added[fin[0].well][fin[0].part[0]] = 1  # indicate the part's been added
     fin[0].changed = True # beginning the distribuiton => new tip taken => change the indicator
-    ops.pop(0) # remove from the list of unperformed operations
+    tip.push(fin[0].part, True)
+    buckets.remove(0) # remove from the unperformed operations
 
     # PART 2.2: all other operations
     while (len(fin) < all_operations):
         #print(str(len(fin))+' of '+str(all_operations)+' operations')  # uncomment if need to track the progress
         # get next operation
-        nextop = nns_oneiter_with_w(ops, fin, 1, depth,added)
-        nextcost = cost_func_with_w(fin, ops[nextop], w, added, caps) # get next operation's cost
+        nextop = nns_oneiter_with_w(ops, opsarr, buckets, fin, 1, depth, added, tip)
+        nextcost = cost_func_batch(fin, opsarr[nextop:nextop+1], globwmat, added, caps, tip)[0] # get next operation's cost
 
         fin.append(ops[nextop]) # record next operation
         added[ops[nextop].well][ops[nextop].part[0]] = 1 #indicate the part's been added
+        tip.push(ops[nextop].part, nextcost == 1) # update the tip's state
         # if the tip's been changed (operation cost 1), indicate that
         if (nextcost == 1):
             fin[-1].changed = True
-        ops.pop(nextop) # remove the operation from the list of unperformed operations
+        buckets.remove(nextop) # remove the operation from the unperformed operations
 
 
 # single iteration of NNs
-def nns_oneiter_with_w(ops, fin, curdepth, depth, added):
-    # PART 1: determine the potential cost of each possible operation
-    potcost = [] # initialise list of potential costs
-    for i in range(0, len(ops)):
-        # get cost of choosing this operation
-        potcost.append(cost_func_with_w(fin, ops[i], globw, added, globcaps))
-        # go deeper (if needed and possible)
-        if (curdepth < depth and len(ops) != 1):
+def nns_oneiter_with_w(ops, opsarr, buckets, fin, curdepth, depth, added, tip):
+    # PART 1: determine the cost of each possible operation
+    # only operations with the same part as the last one can be free, all others need a new tip (cost 1)
+    same = buckets.candidates(globw.partid[fin[-1].well][fin[-1].part[0]])
+    samecost = cost_func_batch(fin, opsarr[same], globwmat, added, globcaps, tip)
+    free = [same[k] for k in np.flatnonzero(samecost == 0)]
+
+    # PART 2: if not going deeper, the least cost is 0 for the first free operation and 1 for the first operation otherwise
+    if (curdepth == depth or buckets.left == 1):
+        if (len(free) != 0):
+            answer, mincost = free[0], 0
+        else:
+            answer, mincost = int(np.min(buckets.firsts()[1])), 1
+
+    # PART 3: going deeper, try free operations first, then all others (in original order)
+    # an operation's potential cost is at least its own cost, so once it can't beat the best one found so far, neither can
+    # any of the following (ties are resolved in favour of the earlier operation)
+    else:
+        answer, mincost = None, None
+        freeset = set(free)
+        cands = itertools.chain(((i, 0) for i in free), ((i, 1) for i in buckets if i not in freeset))
+        for i, cost in cands:
+            if (answer != None and (cost > mincost or (cost == mincost and (curdepth != 1 or i > answer)))):
+                break
+
             # change the inputs as if this operation was chosen
-            added[ops[i].well][ops[i].part[0]] = 1
-            fin.append(ops[i])
+            op = ops[i]
+            buckets.take(i)
+            added[op.well][op.part[0]] = 1
+            fin.append(op)
             fin[-1].changed=True
-            ops.pop(i)
+            tip.push(op.part, True)
 
             # call the single-iteration function again
-            potcost[i] += nns_oneiter_with_w(ops, fin, curdepth + 1, depth, added)
+            potcost = cost + nns_oneiter_with_w(ops, opsarr, buckets, fin, curdepth + 1, depth, added, tip)
 
             # change the inputs back
-            ops.insert(i, fin[-1])
+            tip.pop()
             fin[-1].changed = False
             fin.pop()
-            added[ops[i].well][ops[i].part[0]] = 0
+            added[op.well][op.part[0]] = 0
+            buckets.putback(i)
+
+            # record if better
+            if (answer == None or potcost < mincost or (potcost == mincost and i < answer)):
+                answer, mincost = i, potcost
 
-    # PART 2: act according to the determined costs
+    # PART 4: act according to the determined costs
     # if the current depth is 1, return the entry with the least potential cost
     if (curdepth == 1):
-        answer = potcost.index(min(potcost))
+        return int(answer)
     # if current depth is greater, return the minimum potential cost to add to current subset's potential cost
     else:
-        answer = min(potcost)
-
-    return answer
+        return mincost
 
 
 # ----------------------------------GREEDY SOLVER--------------------------------
@@ -87,18 +126,36 @@ def nns_oneiter_with_w(ops, fin, curdepth, depth, added):
 def greedy_tree(w, fin, heur, reord,caps):
     # PART 1: intial preparations
 
+    # PART 1.0: compile the input (w can also be given as a Problem)
+    w = to_problem(w, caps)
+    caps = w.caps
+
     # PART 1.1: get an Oper list of operations to be performed
     ops = []
     w_to_ops(w, ops, reord)
     all_operations = len(ops)  # get the total number of subsets
 
-    # PART 1.3: make w and capacity global for simplicity
-    global globw, globcaps
+    # PART 1.2: get the same operations as an integer array for batch cost evaluation
+    opsarr = ops_to_array(ops)
+
+    # PART 1.3: make w (also in integer matrix form) and capacity global for simplicity
+    global globw, globwmat, globcaps
     globw = w
+    globwmat = w.wmat
     globcaps = caps
 
     # PART 1.4: create the array added (tells which parts were added to which well)
-    added = np.zeros((len(w), len(w[0])), dtype=bool)  # added[i][j]==True if part at address j in well i has been added
+    added = np.zeros((w.n_wells, w.n_types), dtype=bool)  # added[i][j]==True if part at address j in well i has been added
+
+    # PART 1.5: keep track of the tip's contents to check capacity quickly
+    tip = TipState()
+
+    # PART 1.6: group unperformed operations by part; this also counts the remaining operations for each part (needed for heuristics)
+    buckets = PartBuckets(w.partid[opsarr[:, 2], opsarr[:, 0]], w.n_parts)
+    if (caps != None):
+        caparr = w.caparr
+    else:
+        caparr = np.full(w.n_parts, all_operations) # no capacity limit => any part can be delivered with one tip
 
 
     # PART 2: get the sequence of operations
@@ -107,78 +164,201 @@ def greedy_tree(w, fin, heur, reord,caps):
     fin.append(ops[0])  # record operation
     added[fin[0].well][fin[0].part[0]] = 1  # indicate the part's been added
     fin[0].changed = True  # beginning the distribuiton => new tip taken => change the indicator
-    ops.pop(0)  # remove from the list of unperformed operations
+    tip.push(fin[0].part, True)
+    buckets.remove(0)  # remove from the unperformed operations
 
     # PART 2.2: all other operations
     while (len(fin) < all_operations):
         #print(str(len(fin))+' of '+str(all_operations)+' operations')  # uncomment if need to track the progress
 
         # get next operation
-        nextop = greedy_tree_onestep(ops, fin, w, added, heur)
-        nextcost = cost_func_with_w(fin, ops[nextop], w, added, caps)  # get next operation's cost
+        nextop = greedy_tree_onestep(opsarr, buckets, fin, added, caparr, heur, tip)
+        nextcost = cost_func_batch(fin, opsarr[nextop:nextop+1], globwmat, added, caps, tip)[0]  # get next operation's cost
 
         fin.append(ops[nextop])  # record next operation
         added[ops[nextop].well][ops[nextop].part[0]] = 1  # indicate the part's been added
+        tip.push(ops[nextop].part, nextcost == 1)  # update the tip's state
         # if the tip's been changed (operation cost 1), indicate that
         if (nextcost == 1):
             fin[-1].changed = True
-        ops.pop(nextop)  # remove the operation from the list of unperformed operations
+        buckets.remove(nextop)  # remove the operation from the unperformed operations
 
 
 # single step of greedy search
-def greedy_tree_onestep(ops, fin, w, added, heur):
-    # PART 1: determine the potential cost+heuristic of each possible operation
-    potcost = []
-    for i in range(0, len(ops)):
-        # PART 1.1: cost function component
-        potcost.append(cost_func_with_w(fin, ops[i], w, added, globcaps))
-
-        # PART 1.2: heuristic component
-        # pretend the current subset is included in the route
-        fin.append(ops[i])
-        ops.pop(i)
-
-        # get the heuristic value
-        potcost[-1] += h_tree(fin, ops, heur)
+def greedy_tree_onestep(opsarr, buckets, fin, added, caparr, heur, tip):
+    # PART 1: the heuristic only depends on the operation's part, so each part is represented by its first operation
+    parts, firstops = buckets.firsts()
+    potcost = 1 + h_tree(parts, buckets.remain, caparr, heur) # operations with a different part than the last one cost 1
+
+    # PART 2: operations with the same part as the last one may cost 0
+    lastpid = globw.partid[fin[-1].well][fin[-1].part[0]]
+    k = np.searchsorted(parts, lastpid)
+    if (k < len(parts) and parts[k] == lastpid):
+        # only look through them if even cost 0 could make the part the best one
+        potcost[k] -= 1
+        if (potcost[k] <= np.min(potcost)):
+            same = buckets.candidates(lastpid)
+            free = np.flatnonzero(cost_func_batch(fin, opsarr[same], globwmat, added, globcaps, tip) == 0)
+            if (len(free) != 0):
+                firstops[k] = same[free[0]]
+            else:
+                potcost[k] += 1
+        else:
+            potcost[k] += 1
 
-        # undo including the current subset into the route
-        ops.insert(i, fin[-1])
-        fin.pop()
+    # PART 3: return the index of the operation with the minimal cost+heuristic (the earliest one in case of a tie)
+    return int(firstops[np.lexsort((firstops, potcost))[0]])
 
-    # PART 2: return the index of subset with the minimal cost+heuristic
-    return potcost.index(min(potcost))
 
+# heuristic function: for each candidate operation (given by its part id in pids), get the heuristic value
+# of the state after performing it; remain gives the number of unperformed operations for each part
+def h_tree(pids, remain, caparr, heur):
+    # number of operations that would remain for the candidate's part
+    left = remain[pids] - 1
 
-# heuristic function
-def h_tree(state, unstate, heur):
     # optimistic: h is the number of future tip changes assuming tips only change between different parts
     if (heur == 'optimistic'):
-        already = []
-        for unop in unstate:
-            ispresent = False
-            for alread in already:
-                if (unop.part == alread):
-                    ispresent = True
-                    break
-            if not ispresent:
-                already.append(unop.part)
-        return len(already)
+        # count parts with unperformed operations, excluding the candidate's part if it would have none left
+        return np.count_nonzero(remain) - (left == 0)
 
     # optimistic+cap: h is the number of future  tip changes,
     # assuming tips only change between different parts and due to pipette capacity
     elif (heur == 'optimistic+cap'):
-        subsets=[]
-        ops_to_subsets(unstate,subsets)
-        est_cost=0
-        for subset in subsets:
-            # for the current part (subset), get the number of tips needed to deliver
-            est_cost += np.ceil(len(subset.wells)/globcaps[subset.part])
-
-            # if the current part (subset) is the same as last part added, assume the tip is kept from then
-            if(subset.part == state[-1].part):
-                est_cost -= 1
+        # for every part, get the number of tips needed to deliver it
+        tips = -(-remain // caparr)
+        # change the number of tips for the candidate's part
+        est_cost = tips.sum() - tips[pids] - (-left // caparr[pids])
+        # if there are operations left for the candidate's part, assume the tip is kept from the candidate
+        est_cost -= (left > 0)
         return est_cost
 
+    return np.zeros(len(pids))
+
+
+# -------------------------------BEAM SEARCH SOLVER-------------------------------
+# Partial sequence of operations kept in the beam
+# Only the last operation is stored in the state itself; the earlier ones are reached through a chain of
+# (index, tip change indicator, previous history) tuples shared with the parent, so a child takes O(1) time to record
+class BeamState:
+    # initialisation (empty sequence)
+    def __init__(self, w, all_operations, remain):
+        self.history = None # index and tip change indicator of the last operation, and the history before it
+        self.last = None # last performed operation (the only one needed by the cost function)
+        self.cost = 0 # number of tips used so far
+        self.added = np.zeros((w.n_wells, w.n_types), dtype=bool) # tells which parts were added to which well
+        self.unperformed = np.ones(all_operations, dtype=bool) # tells which operations are not yet performed
+        self.remain = remain.copy() # number of unperformed operations for each part
+        self.tip = TipState() # contents of the tip
+
+    # get a new state by performing operation i (of part pid, taken from ops) at a given cost
+    def child(self, i, op, pid, cost):
+        cost = int(cost)
+        new = BeamState.__new__(BeamState)
+        new.history = (int(i), cost == 1, self.history)
+        new.last = op
+        new.cost = self.cost + cost
+        new.added = self.added.copy()
+        new.added[op.well][op.part[0]] = True
+        new.unperformed = self.unperformed.copy()
+        new.unperformed[i] = False
+        new.remain = self.remain.copy()
+        new.remain[pid] -= 1
+        new.tip = self.tip.copy()
+        new.tip.push(op.part, cost == 1)
+        return new
+
+    # get the indices of performed operations and their tip change indicators, in order
+    def sequence(self):
+        order = []
+        changed = []
+        history = self.history
+        while (history != None):
+            order.append(history[0])
+            changed.append(history[1])
+            history = history[2]
+        order.reverse()
+        changed.reverse()
+        return order, changed
+
+
+# Beam search: keeps the beam_width best partial sequences, scored by their cost plus the optimistic+cap heuristic
+# Every depth operations, the beam is narrowed to its best sequence (depth=None: one beam for the whole sequence)
+# With beam_width=1, this is the same as greedy_tree with the optimistic+cap heuristic
+# A single-sequence pass is made first: if it already meets the lower bound on the number of tips, it is optimal and the
+# full search is skipped; otherwise the better of the two is returned
+def beam_search(w, fin, beam_width, depth, reord, caps):
+    # PART 1: intial preparations
+
+    # PART 1.0: compile the input (w can also be given as a Problem)
+    w = to_problem(w, caps)
+    caps = w.caps
+
+    # PART 1.1: get an Oper list of operations to be performed, and the same operations as an integer array
+    ops = []
+    w_to_ops(w, ops, reord)
+    all_operations = len(ops)
+    opsarr = ops_to_array(ops)
+
+    # PART 1.2: get part ids of the operations and count the operations for each part (needed for the heuristic)
+    opspid = w.partid[opsarr[:, 2], opsarr[:, 0]]
+    remain = np.bincount(opspid, minlength=w.n_parts)
+    if (caps != None):
+        caparr = w.caparr
+    else:
+        caparr = np.full(w.n_parts, all_operations) # no capacity limit => any part can be delivered with one tip
+
+
+    # PART 2: get the sequence of operations
+    beststate = beam_pass(w, ops, opsarr, opspid, remain, caparr, caps, 1, depth)
+    if (beam_width > 1 and beststate.cost > lower_bound(w, caps)):
+        fullstate = beam_pass(w, ops, opsarr, opspid, remain, caparr, caps, beam_width, depth)
+        if (fullstate.cost <= beststate.cost):
+            beststate = fullstate
+
+    # PART 3: record the best sequence in fin
+    order, changed = beststate.sequence()
+    for i in range(0, all_operations):
+        fin.append(ops[order[i]])
+        fin[-1].changed = changed[i]
+
+
+# one pass of beam search with a given beam width, returns the best complete sequence's state
+def beam_pass(w, ops, opsarr, opspid, remain, caparr, caps, beam_width, depth):
+    all_operations = len(ops)
+
+    # PART 1: first operation
+    beam = [BeamState(w, all_operations, remain).child(0, ops[0], opspid[0], 1)]
+
+    # PART 2: all other operations
+    for step in range(1, all_operations):
+        # PART 2.1: score all possible continuations of every sequence in the beam
+        scores = []
+        whichstate = []
+        whichop = []
+        opcosts = []
+        for s in range(0, len(beam)):
+            state = beam[s]
+            cands = np.flatnonzero(state.unperformed)
+            costs = cost_func_batch([state.last], opsarr[cands], w.wmat, state.added, caps, state.tip)
+            scores.append(state.cost + costs + h_tree(opspid[cands], state.remain, caparr, 'optimistic+cap'))
+            whichstate.append(np.full(len(cands), s))
+            whichop.append(cands)
+            opcosts.append(costs)
+        scores = np.concatenate(scores)
+        whichstate = np.concatenate(whichstate)
+        whichop = np.concatenate(whichop)
+        opcosts = np.concatenate(opcosts)
+
+        # PART 2.2: keep the best continuations (ties broken by order in the beam, then by order of operations)
+        best = np.lexsort((whichop, whichstate, scores))[:beam_width]
+        beam = [beam[whichstate[b]].child(whichop[b], ops[whichop[b]], opspid[whichop[b]], opcosts[b]) for b in best]
+
+        # PART 2.3: if the depth budget is reached, narrow the beam to the best sequence
+        if (depth != None and step % depth == 0):
+            beam = beam[:1]
+
+    return beam[0] # the beam is sorted, and the heuristic is zero for complete sequences
+
 
 # -------------------------------MAIN (TESTING ONLY!)-----------------------------
 def main():
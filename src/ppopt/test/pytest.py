@@ -2,10 +2,15 @@
 # By Kirill Sechkar
 # v0.1.0, 1.6.21
 
-from ppopt.statespace import nns, greedy_tree
+from ppopt.statespace import nns, greedy_tree, beam_search
 from ppopt.lp import lp_method
-from ppopt.dp import dp_method
+from ppopt.dp import dp_method, dp_bounded
 from ppopt.auxil import *
+from ppopt.lp.lp_solver import lp_cap, dp_lp_cap, lp_cache_clear, cache, cache_stats
+from ppopt.test.input_generator import wgenerator
+import time
+import pickle
+from itertools import permutations
 
 
 # -----------------FUNCTION DEFINITIONS------------------
@@ -31,10 +36,18 @@ def validate_each(w, caps, methods):
         print('Checking '+method+'...')
         fin = [] # empty array for output
         if (method[0:2] == 'LP'): # LP methods
-            if (len(method) == 2):
-                lp_method(w, fin, reord=None, caps=caps, maxtime=1)
+            # define the solver (given in brackets at the end)
+            if (method[-1] == ')'):
+                solver = method[method.rindex('(') + 1:-1]
+                lpmethod = method[:method.rindex('(') - 1]
+            else:
+                solver = None
+                lpmethod = method
+            # get solution
+            if (len(lpmethod) == 2):
+                lp_method(w, fin, reord=None, caps=caps, maxtime=1, solver=solver)
             else:
-                lp_method(w, fin, method[3:], caps=caps, maxtime=1)
+                lp_method(w, fin, lpmethod[3:], caps=caps, maxtime=1, solver=solver)
 
         elif (method[0:2] == 'DP'): # dynamic programming methods
             if (len(method) == 2):
@@ -42,6 +55,12 @@ def validate_each(w, caps, methods):
             else:
                 dp_method(w, fin, method[3:], caps=caps)
 
+        elif (method[0:10] == 'Bounded DP'): # bounded dynamic programming methods
+            if (len(method) == 10):
+                dp_bounded(w, fin, reord=None, caps=caps)
+            else:
+                dp_bounded(w, fin, method[11:], caps=caps)
+
         else: # state-space methods
             # define reordering
             if (method[-12:] == 'sametogether'):
@@ -55,20 +74,77 @@ def validate_each(w, caps, methods):
                 nns(w, fin, 2, reord, caps)
             elif (method[:6] == 'Greedy'):
                 greedy_tree(w, fin, 'optimistic+cap', reord, caps)
+            elif (method[:4] == 'Beam'):
+                beam_search(w, fin, 8, None, reord, caps)
         costs[method]=[route_cost(fin),independent_cost(fin, w, caps)[0]]
     
     # return the dictionary of costs
     return costs
 
 
+# function checking if the sequence of operations plan (e.g. a Plan) has the same operations as the list ops
+def same_ops(plan, ops):
+    if (len(plan) != len(ops)):
+        return False
+    for i in range(0, len(ops)):
+        if (plan[i].part != ops[i].part or plan[i].well != ops[i].well or plan[i].changed != ops[i].changed):
+            return False
+    return True
+
+
+# function checking if chains (lists of wells 1..n) cover the wells of the LP problem with distance matrix D exactly once,
+# only going along zero-length edges and holding at most cap wells each
+def valid_cover(chains, D, cap):
+    wells = sorted(well for chain in chains for well in chain)
+    if (wells != list(range(1, len(D)))):
+        return False
+    for chain in chains:
+        if (len(chain) > cap):
+            return False
+        for i in range(1, len(chain)):
+            if (D[chain[i - 1], chain[i]] != 0):
+                return False
+    return True
+
+
+# function generating a random LP problem distance matrix for n wells, where each edge between wells has zero length with
+# probability pzero (edges to and from the depot always have zero length)
+def random_D(n, pzero):
+    D = (np.random.rand(n + 1, n + 1) >= pzero).astype(int)
+    D[0, :] = 0
+    D[:, 0] = 0
+    np.fill_diagonal(D, 1)
+    return D
+
+
+# function finding the least number of chains covering the wells of the LP problem with distance matrix D by brute force:
+# every order of wells is cut into chains where the edge to the next well is not zero-length or the chain is full
+def brute_lp_cap(D, cap):
+    best = len(D) - 1
+    for order in permutations(range(1, len(D))):
+        chains = 1
+        length = 1
+        for i in range(1, len(order)):
+            if (D[order[i - 1], order[i]] == 0 and length < cap):
+                length += 1
+            else:
+                chains += 1
+                length = 1
+        best = min(best, chains)
+    return best
+
+
 # --------------------MAIN FUNCTION----------------------
 def main():
     # array containing descriptors of all method tested
-    methods = ['Nearest Neighbour', 'NNs depth2', 'Greedy',
-               'Nearest Neighbour+sametogether', 'NNs depth2+sametogether', 'Greedy+sametogether',
-               'Nearest Neighbour+leastout', 'NNs depth2+leastout', 'Greedy+leastout',
+    methods = ['Nearest Neighbour', 'NNs depth2', 'Greedy', 'Beam search',
+               'Nearest Neighbour+sametogether', 'NNs depth2+sametogether', 'Greedy+sametogether', 'Beam search+sametogether',
+               'Nearest Neighbour+leastout', 'NNs depth2+leastout', 'Greedy+leastout', 'Beam search+leastout',
                'LP', 'LP+random', 'LP+sametogether', 'LP+greedy', 'LP+nearest neighbour', 'LP+nns depth 2',
-               'DP', 'DP+random', 'DP+sametogether', 'DP+leastout']
+               'LP+greedy surrogate', 'LP+nns depth 2 surrogate',
+               'LP (matching)', 'LP+sametogether (matching)', 'LP (CP-SAT)', 'LP+sametogether (CP-SAT)',
+               'DP', 'DP+random', 'DP+sametogether', 'DP+leastout',
+               'Bounded DP', 'Bounded DP+sametogether']
 
     # PART 1: check with a 5-part input of 48 wells where all parts are different
     # The number of pipette tips used must be the maximum possible in all cases
@@ -96,6 +172,9 @@ def main():
     # run the algorithm for all methods
     costs_alldiff=validate_each(w=w_alldiff, caps=caps_alldiff, methods=methods)
     
+    # the lower bound on the cost must be exact, as no tips can be saved
+    assert (lower_bound(w_alldiff, caps_alldiff) == 48 * 5)
+
     #  compare to the expected correct cost of maximum value 48*5
     for costpair in costs_alldiff.values():
         assert (costpair[0] == 48 * 5)
@@ -140,6 +219,151 @@ def main():
         assert ((costpair[0] >= 31) and (costpair[0] <= 40))
         assert ((costpair[0] >= 31) and (costpair[0] <= 40))
 
+    # no method can do better than the lower bound
+    lb_known = lower_bound(w_known, caps_known)
+    assert ((lb_known >= 31) and (lb_known <= 40))
+    for costpair in costs_known.values():
+        assert (costpair[1] >= lb_known)
+
+    # PART 3: check that the LP method keeps to its deadline, solving the subsets one by one and in parallel
+    print('Checking the LP method with a deadline...\n')
+
+    # get a random 192-well input (required volumes taken from a real instance of Start-Stop assembly)
+    np.random.seed(5)
+    w_big = wgenerator(192, 6, 6, 3, 4)
+    ss_big = []
+    w_to_subsets(w_big, ss_big)
+    reqvols = {}
+    for s in ss_big:
+        reqvols[s.part] = [1.09, 0.33, 0.36, 0.75][s.part[0]]
+    caps_big = capacities(reqvols, 10, 1.0)
+
+    # the plan must be made by the deadline (allowing 10% for the solvers stopping late) and be valid, i.e. no operation
+    # may need a tip change that is not made (with little time, a few changes made may be unnecessary)
+    for workers in [None, 2]:
+        for deadline in [0.3, 1]:
+            lp_cache_clear() # solutions cached by the previous runs would make this one faster
+            fin = []
+            start = time.time()
+            lp_method(w_big, fin, reord=None, caps=caps_big, maxtime=None, workers=workers, deadline=deadline)
+            assert (time.time() - start <= deadline * 1.1)
+            for op, cost in verify_iter(fin, w_big, caps_big, keepchanges=True):
+                assert (op.changed or cost == 0)
+            # only the solutions that don't depend on the time limit may be cached (those solved in this process)
+            for key in cache.keys():
+                assert (cache[key][1] == 'OPTIMAL' or key[2] == 'matching')
+
+    # PART 4: check that a Plan stores operations the same way as a list of them
+    print('Checking the Plan...\n')
+
+    # get the operations of the known input, changing the tip before every third one
+    ops_known = []
+    w_to_ops(w_known, ops_known, None)
+    for i in range(0, len(ops_known)):
+        ops_known[i].changed = (i % 3 == 0)
+    plan = Plan(ops_known)
+
+    # the plan must give back the same operations, also after slicing and pickling
+    assert same_ops(plan, ops_known)
+    assert same_ops(plan[5:12], ops_known[5:12])
+    assert same_ops(pickle.loads(pickle.dumps(plan)), ops_known)
+    assert (route_cost(plan) == route_cost(ops_known))
+
+    # changing an operation viewed in the plan changes the plan; popping and inserting it back restores the plan
+    plan[4].changed = True
+    assert (plan.changes[4] == 1)
+    plan[4].changed = False
+    op = plan.pop(7)
+    assert (len(plan) == len(ops_known) - 1)
+    plan.insert(7, op)
+    assert same_ops(plan, ops_known)
+
+    # PART 5: check that the plan verifier finds the tip changes that are missing or unnecessary
+    print('Checking the plan verifier...\n')
+
+    # 3-well input where wells 0 and 2 are the same, capacity 2 for all parts
+    w_check = [[(0,0), (1,0)], [(0,0), (1,1)], [(0,0), (1,0)]]
+    caps_check = {(0,0): 2, (1,0): 2, (1,1): 2}
+
+    # the tip is kept after well 0, which contaminates well 1 with part (1,0)
+    fin_contam = Plan([Oper((1,0), 0), Oper((0,0), 0), Oper((0,0), 1), Oper((0,0), 2)])
+    fin_contam[0].changed = True
+    fin_contam[1].changed = True
+    cost, different = verify_plan(fin_contam, w_check, caps_check)
+    assert (cost == 3)
+    assert ([(diffop.well, diffop.changed, place) for diffop, place in different] == [(1, True, '2')])
+
+    # changing the tip where it must be changed gives a valid plan
+    for op, cost in verify_iter(fin_contam, w_check, caps_check, keepchanges=True):
+        if (cost == 1):
+            op.changed = True
+    assert (route_cost(fin_contam) == 3)
+    assert (verify_plan(fin_contam, w_check, caps_check)[1] == [])
+
+    # an unnecessary tip change before operation 1 lets the tip deliver operation 2 without exceeding the capacity, which
+    # is only taken into account if the changes in the plan are kept
+    fin_cap = Plan([Oper((0,0), 0), Oper((0,0), 1), Oper((0,0), 2)])
+    fin_cap[0].changed = True
+    fin_cap[1].changed = True
+    assert ([cost for op, cost in verify_iter(fin_cap, w_check, caps_check)] == [1, 0, 1])
+    assert ([cost for op, cost in verify_iter(fin_cap, w_check, caps_check, keepchanges=True)] == [1, 0, 0])
+    cost, different = verify_plan(fin_cap, w_check, caps_check)
+    assert ([(diffop.well, diffop.changed, place) for diffop, place in different] == [(1, False, '1'), (2, True, '2')])
+
+    # PART 6: check the cache of LP problem solutions
+    print('Checking the LP solution cache...\n')
+
+    # solving the same problem again, or the problem with its wells renumbered, must give the cached solution
+    np.random.seed(7)
+    lp_cache_clear()
+    D_cache = random_D(10, 0.4)
+    chains = lp_cap(D_cache, 3, 1)
+    assert (cache_stats['misses'] == 1 and valid_cover(chains, D_cache, 3))
+    assert (lp_cap(D_cache, 3, 1) == chains and cache_stats['hits'] == 1)
+    renumber = np.concatenate(([0], np.random.permutation(10) + 1))
+    D_renumbered = D_cache[np.ix_(renumber, renumber)]
+    chains_renumbered = lp_cap(D_renumbered, 3, 1)
+    assert (cache_stats['hits'] == 2 and cache_stats['misses'] == 1)
+    assert (valid_cover(chains_renumbered, D_renumbered, 3) and len(chains_renumbered) == len(chains))
+    assert (chains_renumbered.status == chains.status and chains_renumbered.bound == chains.bound)
+
+    # PART 7: check that LP problems made of separate groups of wells are split into them
+    print('Checking the split of LP problems into groups of wells...\n')
+
+    # two groups of 6 and 5 wells, a pair of wells and a single well (no zero edges between them), mixed together
+    np.random.seed(8)
+    groups = [random_D(6, 0.5), random_D(5, 0.5), random_D(2, 1), random_D(1, 1)]
+    D_split = np.ones((15, 15), dtype=int)
+    D_split[0, :] = 0
+    D_split[:, 0] = 0
+    groupof = np.concatenate([np.full(len(D) - 1, g) for g, D in enumerate(groups)]) # group of each well
+    wellsof = np.random.permutation(14) + 1 # wells of the groups, in order
+    start = 0
+    for D in groups:
+        nodes = np.concatenate(([0], wellsof[start:start + len(D) - 1]))
+        D_split[np.ix_(nodes, nodes)] = D
+        start += len(D) - 1
+    groupof = groupof[np.argsort(wellsof)] # group of each well, by well number
+
+    # the chains must stay within the groups, and there must be as many as for the groups solved separately
+    lp_cache_clear()
+    chains = lp_cap(D_split, 3, 1)
+    assert (cache_stats['split'] == 1 and valid_cover(chains, D_split, 3))
+    for chain in chains:
+        assert (len(set(groupof[np.array(chain) - 1])) == 1)
+    assert (len(chains) == sum(len(lp_cap(D, 3, 1)) for D in groups))
+    assert (chains.optimal() and chains.bound == len(chains))
+
+    # PART 8: check that the exact solver for small LP problems finds the least number of chains
+    print('Checking the exact solver for small LP problems...\n')
+    np.random.seed(9)
+    for n in range(1, 8):
+        for pzero in [0.2, 0.5, 0.8]:
+            for cap in [1, 2, 3, 8]:
+                D_small = random_D(n, pzero)
+                chains = dp_lp_cap(D_small, cap)
+                assert (valid_cover(chains, D_small, cap) and len(chains) == brute_lp_cap(D_small, cap))
+
 
 # main call
 if __name__ == "__main__":